@@ -4,14 +4,32 @@ import gzip
 import sys
 import os
 import io
+import copy
+import json
+import socketserver
+import threading
+import select
+import signal
+import stat
+import time
 from construct.core import ConstError
 import argparse
 import hashlib
+import struct
 from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import ird
 import iso
 
+def md5sum(filename):
+    with open(filename, mode='rb') as f:
+        d = hashlib.md5()
+        for buf in iter(partial(f.read, 1 << 20), b''):
+            d.update(buf)
+    return d.hexdigest()
+
 class FileTree:
     def __init__(self):
         self.files = []
@@ -46,6 +64,13 @@ class FileTree:
                     attrs[attr] = max(value, n)
         return attrs
 
+    def iter_files(self, files=None, prefix=""):
+        if files is None:
+            files = self.files
+        for path, e in iso.IterUdfFiles(files, prefix):
+            if not e['is_dir']:
+                yield path, e
+
     def print_files(self, attrs, print_dirs=False, separator=' | ', print_header=True):
         prefix = ''
         attrs_lens = self._get_max_print_widths(self.files,
@@ -100,19 +125,17 @@ class IrdFile(FileTree):
         parsed = iso.ParseIso(hdr, parse_iso=False)
         self.files = parsed['udf']
 
-    def map_md5sums(self, dir):
+    def map_md5sums(self, dir, hashes=None):
+        if hashes is None:
+            hashes = {f.sector: f.hash.hex() for f in self.content.files}
         for file in dir:
             file['hash'] = ''
             if file['is_dir']:
-                self.map_md5sums(file['content'])
+                self.map_md5sums(file['content'], hashes)
+            elif file['sector'] in hashes:
+                file['hash'] = hashes[file['sector']]
             else:
-                for ird_file in self.content.files:
-                    sector = file['sector']
-                    if sector == ird_file.sector:
-                        file['hash'] = ird_file.hash.hex()
-                        break
-                if 'hash' not in file:
-                    print(f"IRD damaged! File {file['sector']} not found in UDF header")
+                print(f"IRD damaged! File {file['sector']} not found in UDF header")
 
     def id(self):
         return self.content.game_id
@@ -129,6 +152,119 @@ class IrdFile(FileTree):
     def print_header(self):
         print(f"{self.id()} - {self.name()}")
 
+    def regions(self):
+        """Return the (first, last) sector of every disc region, alternating
+        between the unencrypted regions listed in sector 0 and the encrypted
+        regions in between"""
+        hdr = self.content.header
+        count = struct.unpack_from(">I", hdr, 0)[0]
+        plain = [struct.unpack_from(">II", hdr, 8 + 8*i) for i in range(count)]
+        regions = []
+        for i, (first, last) in enumerate(plain):
+            regions += [(first, last)]
+            if i+1 < len(plain):
+                regions += [(last+1, plain[i+1][0]-1)]
+        return regions
+
+class IsoRebuilder:
+    def __init__(self, ird, game_dir, out_file):
+        self.ird = ird
+        self.dir = game_dir
+        self.out_file = out_file
+        self.fd = None
+        self.regions = []
+        self.region_hashes = []
+        self.hashed = 0
+
+    def _hash_until(self, end):
+        # read back what has been written so far and feed it to the hasher of
+        # the region it belongs to, the data is still in the page cache
+        for i, (first, last) in enumerate(self.regions):
+            start = max(first * iso.IsoSectorSize, self.hashed)
+            stop = min((last+1) * iso.IsoSectorSize, end)
+            while start < stop:
+                buf = os.pread(self.fd, min(stop - start, 1 << 20), start)
+                if not buf:
+                    return
+                self.region_hashes[i].update(buf)
+                start += len(buf)
+                self.hashed = start
+
+    def _write(self, data, offset):
+        os.pwrite(self.fd, data, offset)
+        self._hash_until(offset + len(data))
+
+    def rebuild(self):
+        files = sorted(self.ird.iter_files(), key=lambda x: x[1]['sector'])
+        end = len(self.ird.content.header)
+        for path, file in files:
+            end = max(end, file['sector'] * iso.IsoSectorSize + file['size'])
+        footer = self.ird.content.footer
+
+        # the regions cover the whole disc and the footer holds its last
+        # sectors, padding or unlisted sectors may follow the last file
+        self.regions = self.ird.regions()
+        if self.regions:
+            size = (self.regions[-1][1] + 1) * iso.IsoSectorSize
+            footer_offset = size - len(footer)
+        if not self.regions or footer_offset < end:
+            if self.regions:
+                print(f"Footer at sector {footer_offset // iso.IsoSectorSize} would overlap "
+                    f"the files, placing it behind the last file")
+            footer_offset = (end + iso.IsoSectorSize - 1) // iso.IsoSectorSize * iso.IsoSectorSize
+            size = footer_offset + len(footer)
+
+        self.region_hashes = [hashlib.md5() for r in self.regions]
+        if len(self.regions) != len(self.ird.content.regions):
+            print(f"IRD has {len(self.ird.content.regions)} region hashes, but header "
+                f"defines {len(self.regions)} regions, not verifying regions")
+            self.regions = []
+
+        ok = True
+        self.fd = os.open(self.out_file, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(self.fd, size)
+            self._write(self.ird.content.header, 0)
+            for path, file in files:
+                filepath = os.path.join(self.dir, path)
+                offset = file['sector'] * iso.IsoSectorSize
+                if offset < self.hashed:
+                    print(f"{filepath} overlaps previous data at sector {file['sector']}")
+                    ok = False
+                    continue
+                try:
+                    src = os.open(filepath, os.O_RDONLY)
+                except OSError as e:
+                    print(f"{filepath} not readable: {e.strerror}")
+                    ok = False
+                    continue
+                try:
+                    disk_size = os.fstat(src).st_size
+                    if disk_size != file['size']:
+                        print(f"Size mismatch in {filepath}: {disk_size} on disk, {file['size']} in IRD")
+                        ok = False
+                        continue
+                    iso.CopyFileRange(src, self.fd, file['size'], 0, offset)
+                finally:
+                    os.close(src)
+                self._hash_until(offset + file['size'])
+            self._write(footer, footer_offset)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+        for i, (first, last) in enumerate(self.regions):
+            digest = self.region_hashes[i].digest()
+            if digest != self.ird.content.regions[i]:
+                print(f"Region {i} (sectors {first}-{last}) hash mismatch: "
+                    f"{digest.hex()} in ISO, {self.ird.content.regions[i].hex()} in IRD")
+                ok = False
+            else:
+                print(f"Region {i} (sectors {first}-{last}) ok")
+
+        print("ISO VALID" if ok else "ISO INVALID")
+        return ok
+
 class GameDir(FileTree):
     def __init__(self, game_dir):
         super().__init__()
@@ -151,6 +287,14 @@ class GameDir(FileTree):
 
         self.dir_file_mismatch = 0
 
+        self.messages = None
+
+    def _report(self, msg, problem=True):
+        if self.messages is None:
+            print(msg)
+        elif problem:
+            self.messages += [msg]
+
     def get_file_by_path(self, path):
         content = self.files
         for d in filter(lambda x: x, path.split("/")):
@@ -190,13 +334,6 @@ class GameDir(FileTree):
     def print_files(self):
         super().print_files(['name', 'size'])
 
-    def md5sum(self, filename):
-        with open(filename, mode='rb') as f:
-            d = hashlib.md5()
-            for buf in iter(partial(f.read, 4096), b''):
-                d.update(buf)
-        return d.hexdigest()
-
     def _check(self, path, files, ird_files):
         # first, add all disk files and set on_disk attribute
         merged = files
@@ -240,41 +377,55 @@ class GameDir(FileTree):
         for file in merged:
             filepath = os.path.join(path, file['name'])
             if file['on_disk'] and not file['in_ird']:
-                print(f"{filepath} not in IRD")
+                self._report(f"{filepath} not in IRD")
                 if 'content' in file:
                     self.dirs_disk_only += 1
                 else:
                     self.files_disk_only += 1
             elif not file['on_disk'] and file['in_ird']:
-                print(f"{filepath} not on disk", sep=""
-                    "" if file['ird_is_dir'] else
-                    f", should be {file['ird_size']} Bytes, MD5 {file['ird_hash']}")
+                self._report(f"{filepath} not on disk" +
+                    ("" if file['ird_is_dir'] else
+                    f", should be {file['ird_size']} Bytes, MD5 {file['ird_hash']}"))
                 if 'content' in file:
                     self.dirs_ird_only += 1
                 else:
                     self.files_ird_only += 1
             elif file['is_dir'] != file['ird_is_dir']:
-                print(f"{filepath} is file and should be dir or vice versa")
+                self._report(f"{filepath} is file and should be dir or vice versa")
                 self.dir_file_mismatch += 1
             elif not file['is_dir']: # check file size + hash
                 if file['size'] != file['ird_size']:
-                    print(f"Size mismatch in {filepath}: {file['size']} on disk, {file['ird_size']} in IRD")
+                    self._report(f"Size mismatch in {filepath}: {file['size']} on disk, {file['ird_size']} in IRD")
                     self.files_size_mismatch += 1
                 else:
-                    file['hash'] = self.md5sum(filepath)
-                    if file['hash'] != file['hash']:
-                        print(f"Hash mismatch in {filepath}: {file['hash']} on disk, {file['ird_hash']} in IRD")
+                    file['hash'] = md5sum(filepath)
+                    if file['hash'] != file['ird_hash']:
+                        self._report(f"Hash mismatch in {filepath}: {file['hash']} on disk, {file['ird_hash']} in IRD")
                         self.files_hash_mismatch += 1
                     else:
-                        print("File ok: "+filepath)
+                        self._report("File ok: "+filepath, problem=False)
                         self.files_ok += 1
             else:
                 self.dirs_ok += 1
             if file['is_dir'] or file['ird_is_dir']:
                 self._check(f"{filepath}/", file['content'], file['ird_content'])
 
+    def counters(self):
+        return {k: v for k, v in vars(self).items() if k.startswith(('files_', 'dirs_', 'dir_'))}
+
+    def valid(self):
+        return not (self.files_disk != self.files_ird or \
+            self.files_disk_only+self.files_ird_only+self.files_size_mismatch+self.files_hash_mismatch > 0 or \
+            self.dirs_disk != self.dirs_ird or \
+            self.dirs_disk_only+self.dir_file_mismatch+self.dirs_ird_only > 0)
+
+    def verify(self, ird):
+        # _check merges into the IRD tree, keep the IrdFile reusable
+        self._check(self.dir, self.files, copy.deepcopy(ird.files))
+        return self.valid()
+
     def check(self, ird):
-        self._check(self.dir, self.files, ird.files)
+        self.verify(ird)
 
         print(f"Dirs on disk:             {self.dirs_disk}")
         print(f"Dirs in ird:              {self.dirs_ird}")
@@ -291,14 +442,507 @@ class GameDir(FileTree):
         print(f"Files with size mismatch: {self.files_size_mismatch}")
         print(f"Files with hash mismatch: {self.files_hash_mismatch}")
 
-        if self.files_disk != self.files_ird or \
-            self.files_disk_only+self.files_ird_only+self.files_size_mismatch+self.files_hash_mismatch > 0 or \
-            self.dirs_disk != self.dirs_ird or \
-            self.dirs_disk_only+self.dir_file_mismatch+self.dirs_ird_only > 0:
+        if not self.valid():
             print("GAME DATA INVALID")
         else:
             print("GAME DATA VALID")
 
+class Inotify:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_CREATE | IN_DELETE | IN_MOVE_SELF
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify not supported")
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.moves = {}
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            errno = self.ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches.pop(wd, None)
+
+    def _below(self, top):
+        return [(wd, path) for wd, path in self.watches.items()
+            if path == top or path.startswith(top + os.sep)]
+
+    def _rename(self, old, new):
+        for wd, path in self._below(old):
+            self.watches[wd] = new + path[len(old):]
+
+    def _forget(self, top):
+        for wd, path in self._below(top):
+            self.rm_watch(wd)
+
+    def read_events(self, timeout):
+        """Return a list of (directory, mask, name) events, waiting at most timeout seconds"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        buf = os.read(self.fd, 1 << 16)
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = struct.unpack_from("iIII", buf, pos)
+            name = os.fsdecode(buf[pos+16:pos+16+length].rstrip(b"\0"))
+            pos += 16 + length
+            directory = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            # watches keep the path they were added with, follow renamed
+            # directories and drop the ones moved out of sight
+            if directory is not None and mask & self.IN_ISDIR:
+                if mask & self.IN_MOVED_FROM:
+                    self.moves[cookie] = os.path.join(directory, name)
+                elif mask & self.IN_MOVED_TO and cookie in self.moves:
+                    self._rename(self.moves.pop(cookie), os.path.join(directory, name))
+            if directory is not None and mask & self.IN_MOVE_SELF and not os.path.isdir(directory):
+                self._forget(directory)
+            events += [(directory, mask, name)]
+        for cookie in list(self.moves):
+            self._forget(self.moves.pop(cookie))
+        return events
+
+class GameWatcher:
+    """Per-file verification state of one game directory. Files are only
+    hashed again if their size or modification time changed."""
+
+    def __init__(self, ird, game_dir, state=None):
+        self.ird = ird
+        self.dir = os.path.abspath(game_dir)
+        self.expected = dict(ird.iter_files())
+        self.files = dict(state['files']) if state else {}
+
+    def verify(self, path):
+        filepath = os.path.join(self.dir, path)
+        expected = self.expected.get(path)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            if expected is None:
+                self.files.pop(path, None)
+            else:
+                self.files[path] = {'status': 'not on disk'}
+            return
+
+        cached = self.files.get(path, {})
+        info = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+        if expected is None:
+            info['status'] = 'not in IRD'
+        elif st.st_size != expected['size']:
+            info['status'] = 'size mismatch'
+        else:
+            if cached.get('hash') and cached.get('size') == info['size'] and \
+                    cached.get('mtime') == info['mtime']:
+                info['hash'] = cached['hash']
+            else:
+                info['hash'] = md5sum(filepath)
+            info['status'] = 'ok' if info['hash'] == expected['hash'] else 'hash mismatch'
+        self.files[path] = info
+
+    def disk_files(self, subdir=""):
+        files = []
+        for root, dirs, names in os.walk(os.path.join(self.dir, subdir)):
+            rel = os.path.relpath(root, self.dir)
+            files += [n if rel == "." else f"{rel}/{n}" for n in names]
+        return files
+
+    def rescan(self, subdir=""):
+        """Verify all known files below subdir plus whatever is on disk there"""
+        prefix = f"{subdir}/" if subdir else ""
+        paths = {p for p in self.expected if p.startswith(prefix)}
+        paths |= {p for p in self.files if p.startswith(prefix)}
+        paths |= set(self.disk_files(subdir))
+        for path in sorted(paths):
+            self.verify(path)
+
+    def valid(self):
+        return all(self.files.get(p, {}).get('status') == 'ok' for p in self.expected) and \
+            all(info['status'] == 'ok' for info in self.files.values())
+
+    def state(self):
+        return {
+            'ird': self.ird.filename,
+            'game_id': self.ird.id(),
+            'game_name': self.ird.name(),
+            'valid': self.valid(),
+            'files': self.files,
+        }
+
+class LibraryWatcher:
+    """Keeps the verification state of several game directories current,
+    using inotify to find changed files or polling if it is not available"""
+
+    def __init__(self, state_file, interval=10, settle=2, poll=False):
+        self.state_file = state_file
+        self.interval = interval
+        self.settle = settle
+        self.games = {}
+        self.inotify = None
+        if not poll:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                print(f"inotify not available ({e}), polling every {interval}s", file=sys.stderr)
+
+    def add_game(self, ird, game_dir, state=None):
+        game = GameWatcher(ird, game_dir, state)
+        self.games[game.dir] = game
+        return game
+
+    @staticmethod
+    def load_state(state_file):
+        try:
+            with open(state_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'games': {}}
+
+    def save_state(self):
+        state = {'updated': time.time(),
+            'games': {d: g.state() for d, g in self.games.items()}}
+        tmp = f"{self.state_file}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def _report(self, game, was_valid):
+        valid = game.valid()
+        if valid != was_valid:
+            print(f"{game.ird.id()} {game.dir}: GAME DATA {'VALID' if valid else 'INVALID'}")
+            sys.stdout.flush()
+
+    def _watch_tree(self, path):
+        for root, dirs, files in os.walk(path):
+            try:
+                self.inotify.add_watch(root)
+            except OSError as e:
+                print(f"Cannot watch {root}: {e.strerror}", file=sys.stderr)
+
+    def _find_game(self, path):
+        for game_dir, game in self.games.items():
+            if path == game_dir or path.startswith(game_dir + os.sep):
+                return game, os.path.relpath(path, game_dir)
+        return None, None
+
+    def _verify_dirty(self, dirty):
+        for game, paths in dirty.items():
+            was_valid = game.valid()
+            for path, is_dir in paths.items():
+                if is_dir:
+                    game.rescan(path)
+                else:
+                    game.verify(path)
+            self._report(game, was_valid)
+        self.save_state()
+
+    def run(self):
+        for game in self.games.values():
+            game.rescan()
+            print(f"{game.ird.id()} {game.dir}: GAME DATA {'VALID' if game.valid() else 'INVALID'}")
+        self.save_state()
+        sys.stdout.flush()
+
+        if self.inotify is None:
+            while True:
+                time.sleep(self.interval)
+                for game in self.games.values():
+                    was_valid = game.valid()
+                    game.rescan()
+                    self._report(game, was_valid)
+                self.save_state()
+
+        for game in self.games.values():
+            self._watch_tree(game.dir)
+        dirty = {}
+        while True:
+            events = self.inotify.read_events(self.settle if dirty else None)
+            if not events:
+                self._verify_dirty(dirty)
+                dirty = {}
+                continue
+            for directory, mask, name in events:
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    for game in self.games.values():
+                        dirty.setdefault(game, {})[""] = True
+                    continue
+                if directory is None:
+                    continue
+                if mask & Inotify.IN_MOVE_SELF:
+                    # only the game directory itself is not seen by a parent watch
+                    game = self.games.get(directory)
+                    if game is not None:
+                        dirty.setdefault(game, {})[""] = True
+                    continue
+                path = os.path.join(directory, name)
+                game, rel = self._find_game(path)
+                if game is None:
+                    continue
+                is_dir = bool(mask & Inotify.IN_ISDIR)
+                if is_dir and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    self._watch_tree(path)
+                dirty.setdefault(game, {})[rel] = is_dir
+
+class IrdCache:
+    """Bounded LRU cache of parsed IRD files, entries are dropped when the
+    IRD file changes on disk"""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        key = os.path.abspath(filename)
+        st = os.stat(key)
+        version = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                return entry[1]
+        ird = IrdFile(key)
+        with self.lock:
+            self.entries[key] = (version, ird)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return ird
+
+class IrdService:
+    """Answers newline-delimited JSON requests on a Unix socket, one JSON
+    response line per request:
+
+    {"op": "check", "ird": "game.ird", "dir": "game_dir"}
+    {"op": "lookup", "ird": "game.ird", "path": "PS3_GAME/PARAM.SFO"}
+    {"op": "lookup", "ird": "game.ird", "hash": "<md5>"}
+    {"op": "print", "ird": "game.ird"}
+
+    Responses carry "ok": true or "ok": false and an "error" message."""
+
+    def __init__(self, socket_path, cache_size=64, jobs=None):
+        self.socket_path = socket_path
+        self.cache = IrdCache(cache_size)
+        self.pool = ThreadPoolExecutor(max_workers=jobs or os.cpu_count())
+
+    @staticmethod
+    def _file_info(path, file):
+        return {'path': path, 'size': file['size'], 'sector': file['sector'],
+            'hash': file['hash']}
+
+    def op_check(self, req):
+        ird = self.cache.get(req['ird'])
+        game = GameDir(req['dir'])
+        game.messages = []
+        valid = game.verify(ird)
+        return {'game_id': ird.id(), 'valid': valid, 'counters': game.counters(),
+            'problems': game.messages}
+
+    def op_lookup(self, req):
+        ird = self.cache.get(req['ird'])
+        files = [self._file_info(path, f) for path, f in ird.iter_files()
+            if path == req.get('path', path) and f['hash'] == req.get('hash', f['hash'])]
+        return {'game_id': ird.id(), 'files': files}
+
+    def op_print(self, req):
+        ird = self.cache.get(req['ird'])
+        c = ird.content
+        return {'game_id': ird.id(), 'game_name': ird.name(),
+            'version': c.version, 'update_version': c.update_version,
+            'game_version': c.game_version, 'app_version': c.app_version,
+            'regions': [r.hex() for r in c.regions],
+            'files': [self._file_info(path, f) for path, f in ird.iter_files()]}
+
+    def handle(self, req):
+        try:
+            op = getattr(self, f"op_{req['op']}", None)
+            if op is None:
+                raise ValueError(f"Unknown op {req['op']}")
+            res = op(req)
+            res['ok'] = True
+        except Exception as e:
+            res = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+        if 'id' in req:
+            res['id'] = req['id']
+        return res
+
+    def serve_forever(self):
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        req = json.loads(line)
+                        if not isinstance(req, dict):
+                            raise ValueError("Request must be a JSON object")
+                    except ValueError as e:
+                        res = {'ok': False, 'error': f"Invalid request: {e}"}
+                    else:
+                        res = service.pool.submit(service.handle, req).result()
+                    self.wfile.write(json.dumps(res).encode() + b"\n")
+                    self.wfile.flush()
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        with Server(self.socket_path, Handler) as server:
+            print(f"Listening on {self.socket_path}", file=sys.stderr)
+            try:
+                server.serve_forever()
+            finally:
+                os.unlink(self.socket_path)
+                self.pool.shutdown()
+
+def _index_ird(filename):
+    ird = IrdFile(filename)
+    return {
+        'mtime': os.stat(filename).st_mtime_ns,
+        'game_id': ird.id(),
+        'files': [[f['hash'], path, f['size']] for path, f in ird.iter_files()],
+    }
+
+class DupeIndex:
+    """Maps the MD5 of every file listed in a set of IRDs to the games and
+    paths it occurs in. IRDs are only parsed again when they changed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                self.irds = json.load(f)['irds']
+        except FileNotFoundError:
+            self.irds = {}
+
+    @staticmethod
+    def find_irds(paths):
+        irds = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    irds += [os.path.join(root, f) for f in sorted(files)
+                        if f.lower().endswith('.ird')]
+            else:
+                irds += [path]
+        return [os.path.abspath(f) for f in irds]
+
+    def update(self, irds, jobs=None):
+        todo = [f for f in irds if f not in self.irds or
+            self.irds[f]['mtime'] != os.stat(f).st_mtime_ns]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for filename, future in [(f, pool.submit(_index_ird, f)) for f in todo]:
+                try:
+                    self.irds[filename] = future.result()
+                except Exception as e:
+                    print(f"Skipping {filename}: {e}", file=sys.stderr)
+        for filename in list(self.irds):
+            if not os.path.exists(filename):
+                del self.irds[filename]
+        return len(todo)
+
+    def save(self):
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({'irds': self.irds}, f)
+        os.replace(tmp, self.filename)
+
+    def groups(self, irds=None, min_size=1):
+        """Return {md5: [(ird, game_id, path, size), ...]} of all files that
+        occur more than once"""
+        by_hash = {}
+        for filename, entry in self.irds.items():
+            if irds is not None and filename not in irds:
+                continue
+            for md5, path, size in entry['files']:
+                if md5 and size >= min_size:
+                    by_hash.setdefault(md5, []).append((filename, entry['game_id'], path, size))
+        return {md5: files for md5, files in by_hash.items() if len(files) > 1}
+
+    def print_dupes(self, min_size=1):
+        groups = self.groups(min_size=min_size)
+        redundant = 0
+        for md5, files in sorted(groups.items(),
+                key=lambda x: x[1][0][3] * (len(x[1]) - 1), reverse=True):
+            size = files[0][3]
+            redundant += size * (len(files) - 1)
+            print(f"{md5} {size} B x{len(files)} ({size * (len(files) - 1)} B redundant)")
+            for filename, game_id, path, size in files:
+                print(f"    {game_id} {path}")
+        print(f"Duplicate groups:   {len(groups)}")
+        print(f"Duplicate files:    {sum(len(files) for files in groups.values())}")
+        print(f"Redundant storage:  {redundant} B")
+
+    def dedupe(self, game_dirs, min_size=1, dry_run=False):
+        """Hardlink identical files across the extracted game directories,
+        game_dirs maps IRD file names to directories. Every file is checked
+        against the IRD hash before it is linked or replaced."""
+        saved = 0
+        for md5, files in self.groups(set(game_dirs), min_size).items():
+            masters = {}
+            for filename, game_id, path, size in files:
+                filepath = os.path.join(game_dirs[filename], path)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                master = masters.get(st.st_dev)
+                if master is not None and master[1] == st.st_ino:
+                    # already linked to the verified master, nothing to hash
+                    continue
+                if st.st_size != size or md5sum(filepath) != md5:
+                    print(f"Not deduplicating {filepath}: does not match IRD")
+                    continue
+                if master is None:
+                    masters[st.st_dev] = (filepath, st.st_ino)
+                    continue
+                print(f"Linking {filepath} -> {master[0]}")
+                saved += size
+                if not dry_run:
+                    tmp = f"{filepath}.dedupe"
+                    os.link(master[0], tmp)
+                    os.replace(tmp, filepath)
+        print(f"Saved {saved} B")
+        return saved
+
+def print_status(state_file, verbose=False):
+    state = LibraryWatcher.load_state(state_file)
+    for game_dir, game in state['games'].items():
+        print(f"{game['game_id']} {'VALID  ' if game['valid'] else 'INVALID'} {game_dir}")
+        for path, info in sorted(game['files'].items()):
+            if verbose or info['status'] != 'ok':
+                print(f"    {path}: {info['status']}")
+    return all(game['valid'] for game in state['games'].values())
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Read IRD files and test files for conformance')
     action_group = parser.add_mutually_exclusive_group()
@@ -311,28 +955,132 @@ def parse_args():
     action_group.add_argument('-c', '--check',
             dest='action', const='check', action='store_const',
             help='Verify game directory against IRD (default if game dir given)')
+    action_group.add_argument('-r', '--rebuild', metavar='out.iso', dest='rebuild_iso',
+            help='Rebuild the original ISO image from the game directory')
+    action_group.add_argument('-w', '--watch',
+            dest='action', const='watch', action='store_const',
+            help='Keep verifying game directories, re-checking files as they change')
+    action_group.add_argument('--status',
+            dest='action', const='status', action='store_const',
+            help='Print the verification status recorded by --watch')
+    action_group.add_argument('-s', '--serve',
+            dest='action', const='serve', action='store_const',
+            help='Serve check, lookup and print requests as JSON on a Unix socket')
+    action_group.add_argument('-i', '--build-index',
+            dest='action', const='build-index', action='store_const',
+            help='Add the given IRD files or directories of IRDs to the duplicate index')
+    action_group.add_argument('-d', '--dupes',
+            dest='action', const='dupes', action='store_const',
+            help='Print files that occur more than once in the duplicate index')
+    action_group.add_argument('--dedupe',
+            dest='action', const='dedupe', action='store_const',
+            help='Hardlink identical files across the game directories given with -g')
+    parser.add_argument('-g', '--game', nargs=2, metavar=('file.ird', 'game_dir'),
+            dest='games', action='append', default=[],
+            help='Additional game to watch (may be repeated)')
+    parser.add_argument('--state', metavar='state.json', default='irdcheck-state.json',
+            help='File to keep the watch state in (default: %(default)s)')
+    parser.add_argument('--poll', action='store_true',
+            help='Poll for changes instead of using inotify')
+    parser.add_argument('--interval', type=float, default=10,
+            help='Polling interval in seconds (default: %(default)s)')
+    parser.add_argument('--index', metavar='index.json', default='irdcheck-index.json',
+            help='Duplicate index file (default: %(default)s)')
+    parser.add_argument('--min-size', type=int, default=1,
+            help='Ignore duplicates smaller than this many bytes (default: %(default)s)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+            help='Only print what --dedupe would link')
+    parser.add_argument('--socket', metavar='path', default='irdcheck.sock',
+            help='Unix socket to listen on for --serve (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=64,
+            help='Number of parsed IRDs kept in memory by --serve (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int,
+            help='Number of workers for --serve and --build-index (default: number of CPUs)')
     parser.add_argument('-v', '--verbose', action='store_true',
             help='Print more information')
-    parser.add_argument('ird_file', metavar='file.ird',
+    parser.add_argument('ird_file', metavar='file.ird', nargs='?',
             help='IRD file to use')
     parser.add_argument('game_dir', metavar='game_dir', nargs='?',
             help='Directory with game files to be verified')
+    parser.add_argument('more_irds', nargs='*', help=argparse.SUPPRESS)
     parser.set_defaults(action='default')
     args = parser.parse_args()
+    if args.rebuild_iso is not None:
+        args.action = 'rebuild'
     if args.action == 'default':
         if args.game_dir is not None:
             args.action = 'check'
         else:
             args.action = 'print'
-    if args.action == 'check' and args.game_dir is None:
+    if args.action == 'build-index':
+        args.irds = [f for f in [args.ird_file, args.game_dir] + args.more_irds if f is not None]
+        if not args.irds:
+            parser.print_usage()
+            print("error: file.ird is required for building the index")
+            sys.exit(2)
+    elif args.more_irds:
+        parser.print_usage()
+        print("error: unrecognized arguments: " + " ".join(args.more_irds))
+        sys.exit(2)
+    elif args.action in ['watch', 'dedupe']:
+        if args.ird_file is not None:
+            args.games.insert(0, [args.ird_file, args.game_dir])
+        if not args.games or any(d is None for i, d in args.games):
+            parser.print_usage()
+            print(f"error: file.ird and game_dir are required for --{args.action}")
+            sys.exit(2)
+    elif args.action not in ['status', 'serve', 'dupes'] and args.ird_file is None:
+        parser.print_usage()
+        print("error: file.ird is required")
+        sys.exit(2)
+    if args.action in ['check', 'rebuild'] and args.game_dir is None:
         parser.print_usage()
-        print("error: game_dir is required for checking")
+        print(f"error: game_dir is required for {args.action}ing")
         sys.exit(2)
     return args
 
 if __name__ == "__main__":
     args = parse_args()
 
+    if args.action == 'status':
+        sys.exit(0 if print_status(args.state, args.verbose) else 1)
+    elif args.action == 'build-index':
+        index = DupeIndex(args.index)
+        irds = DupeIndex.find_irds(args.irds)
+        print(f"Indexing {len(irds)} IRDs...", file=sys.stderr)
+        n = index.update(irds, args.jobs)
+        index.save()
+        print(f"Parsed {n} new or changed IRDs, {len(index.irds)} IRDs in {args.index}")
+        sys.exit(0)
+    elif args.action == 'dupes':
+        DupeIndex(args.index).print_dupes(args.min_size)
+        sys.exit(0)
+    elif args.action == 'dedupe':
+        index = DupeIndex(args.index)
+        index.update([os.path.abspath(f) for f, d in args.games], args.jobs)
+        index.save()
+        index.dedupe({os.path.abspath(f): d for f, d in args.games}, args.min_size, args.dry_run)
+        sys.exit(0)
+    elif args.action == 'serve':
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            IrdService(args.socket, args.cache_size, args.jobs).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    elif args.action == 'watch':
+        watcher = LibraryWatcher(args.state, args.interval, poll=args.poll)
+        state = LibraryWatcher.load_state(args.state)
+        for ird_file, game_dir in args.games:
+            print(f"Parsing {ird_file}...", file=sys.stderr)
+            watcher.add_game(IrdFile(ird_file), game_dir,
+                state['games'].get(os.path.abspath(game_dir)))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            watcher.save_state()
+        sys.exit(0)
+
     print(f"Parsing {args.ird_file}...", file=sys.stderr)
     ird = IrdFile(args.ird_file)
 
@@ -346,3 +1094,8 @@ if __name__ == "__main__":
         print(f"Crawling {args.game_dir}...", file=sys.stderr)
         game = GameDir(args.game_dir)
         game.check(ird)
+    elif args.action == 'rebuild':
+        ird.print_header()
+        print(f"Rebuilding {args.rebuild_iso}...", file=sys.stderr)
+        if not IsoRebuilder(ird, args.game_dir, args.rebuild_iso).rebuild():
+            sys.exit(1)
@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 
 import sys
+import os
+import errno
+import fnmatch
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import construct as c
 
 IsoSectorSize = 2048
@@ -443,13 +448,45 @@ def GetUdfFileSize(fd, partition_start, entry_sector):
     info = UdfDescriptorAtSector(partition_start + entry_sector).parse_stream(fd)
     size = 0
     sectors = 0
+    extents = []
     for ad in info.desc.allocation_descriptors:
         size += ad.length
         if ad.length > 0:
             sectors += 1
-    return {"size": size, "sectors": sectors,
+            extents += [(partition_start + ad.sector - 32, ad.length)]
+    return {"size": size, "sectors": sectors, "extents": extents,
         "sector": partition_start + info.desc.allocation_descriptors[0].sector - 32}
 
+def CopyFileRange(src_fd, dst_fd, count, src_offset, dst_offset):
+    """Copy count bytes between two file descriptors without passing the data
+    through Python. Uses copy_file_range() where available and falls back to
+    sendfile() and finally a plain pread()/pwrite() loop."""
+    global _copy_method
+    while count > 0:
+        try:
+            if _copy_method == "copy_file_range":
+                n = os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+            elif _copy_method == "sendfile":
+                os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+                n = os.sendfile(dst_fd, src_fd, src_offset, count)
+            else:
+                n = os.pwrite(dst_fd, os.pread(src_fd, min(count, 1 << 20), src_offset), dst_offset)
+        except OSError as e:
+            if _copy_method is None or e.errno not in (errno.EXDEV, errno.ENOSYS,
+                    errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+            _copy_method = "sendfile" if _copy_method == "copy_file_range" and \
+                hasattr(os, "sendfile") else None
+            continue
+        if n == 0:
+            raise EOFError(f"Source ended {count} bytes early")
+        count -= n
+        src_offset += n
+        dst_offset += n
+
+_copy_method = "copy_file_range" if hasattr(os, "copy_file_range") else \
+    "sendfile" if hasattr(os, "sendfile") else None
+
 def ParseUdfDirectory(fd, partition_start, entry_sector, verbose):
     entry = UdfDescriptorAtSector(partition_start + entry_sector).parse_stream(fd)
     if len(entry.desc.allocation_descriptors) != 1:
@@ -516,7 +553,84 @@ def ParseIso(fd, parse_iso=True, parse_udf=True, verbose=False):
             files["udf"] = ParseUdf(fd, vd.payload, verbose)
     return files
 
+def IterUdfFiles(dir, prefix=""):
+    for e in dir:
+        path = f"{prefix}{e['name']}"
+        yield path, e
+        if e['is_dir']:
+            yield from IterUdfFiles(e['content'], f"{path}/")
+
+def SelectUdfFiles(dir, patterns):
+    """Return (path, entry) of every file matching one of the glob patterns,
+    a pattern matching a directory selects everything below it"""
+    selected = []
+    for path, e in IterUdfFiles(dir):
+        if not patterns or any(fnmatch.fnmatchcase(path, p) or
+                any(fnmatch.fnmatchcase(path[:i], p) for i, ch in enumerate(path) if ch == "/")
+                for p in patterns):
+            selected += [(path, e)]
+    return selected
+
+def ExtractUdfFile(fd, entry, filename):
+    out = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if entry['size'] > 0:
+            try:
+                os.posix_fallocate(out, 0, entry['size'])
+            except (AttributeError, OSError):
+                os.ftruncate(out, entry['size'])
+        offset = 0
+        for sector, length in entry['extents']:
+            CopyFileRange(fd, out, length, sector * IsoSectorSize, offset)
+            offset += length
+    finally:
+        os.close(out)
+
+def ExtractUdf(fd, dir, outdir, patterns=None, jobs=None, verbose=False):
+    """Extract the selected files by copying their sector ranges out of the
+    image, only the allocated extents of selected files are read"""
+    selected = SelectUdfFiles(dir, patterns)
+    for path, e in selected:
+        os.makedirs(os.path.join(outdir, path if e['is_dir'] else os.path.dirname(path)),
+            exist_ok=True)
+    files = [(path, e) for path, e in selected if not e['is_dir']]
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = [pool.submit(ExtractUdfFile, fd.fileno(), e, os.path.join(outdir, path))
+            for path, e in files]
+        for (path, e), future in zip(files, futures):
+            future.result()
+            if verbose:
+                print(f"extracted {path} [{e['size']} B]")
+    return len(files)
+
+def parse_extract_args(argv):
+    parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} extract",
+            description='Extract files from the UDF file system of an ISO image')
+    parser.add_argument('-j', '--jobs', type=int,
+            help='Number of parallel extraction workers (default: number of CPUs)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help='Print more information')
+    parser.add_argument('iso_file', metavar='image.iso',
+            help='ISO image to extract from')
+    parser.add_argument('out_dir', metavar='outdir',
+            help='Directory to extract to')
+    parser.add_argument('paths', metavar='paths', nargs='*',
+            help='Files or directories to extract, glob patterns are allowed (default: all)')
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "extract":
+        args = parse_extract_args(sys.argv[2:])
+        with open(args.iso_file, "rb") as fd:
+            files = ParseIso(fd, parse_iso=False, verbose=args.verbose)
+            if "udf" not in files:
+                print("error: no UDF file system found")
+                sys.exit(1)
+            n = ExtractUdf(fd, files['udf'], args.out_dir,
+                [p.strip("/") for p in args.paths], args.jobs, args.verbose)
+        print(f"Extracted {n} files to {args.out_dir}")
+        sys.exit(0)
+
     fd = open(sys.argv[1], "rb")
     files = ParseIso(fd, parse_iso=False, verbose=True)
 
@@ -1,4 +1,5 @@
 import struct, sys
+from itertools import groupby
 
 class StructType(tuple):
 	def __getitem__(self, value):
@@ -12,8 +13,56 @@ class StructType(tuple):
 class StructException(Exception):
 	pass
 
+class StructLayout(object):
+	"""Field layout of a Struct subclass, built once from its __format__.
+	Layouts made of numbers only are compiled into a single struct.Struct."""
+	cache = {}
+	
+	def __init__(self, instance):
+		self.defs = instance.__defs__
+		self.sizes = instance.__sizes__
+		self.attrs = instance.__attrs__
+		self.values = instance.__values__
+		self.arrays = [name for name in self.values if isinstance(self.values[name], list)]
+		# the instance the layout was taken from must not share the defaults
+		object.__setattr__(instance, '__values__', self.newValues())
+		self.struct = None
+		self.fields = None
+		
+		if all(isinstance(sdef, str) for sdef in self.defs):
+			self.struct = struct.Struct(instance.__endian__ + ''.join(self.defs))
+			self.fields = []
+			pos = 0
+			for name, group in groupby(sum(self.attrs, [])):
+				count = len(list(group))
+				if name[0] == '*':
+					self.fields.append((name[1:], pos, pos + count, True))
+					pos += count
+				else:
+					for i in range(count):
+						self.fields.append((name, pos, pos + 1, False))
+						pos += 1
+	
+	def get(cls, structClass):
+		return cls.cache.get(structClass)
+	get = classmethod(get)
+	
+	def add(cls, instance):
+		if Struct in instance.__defs__:
+			# nested structs need fresh instances, keep formatting those each time
+			return None
+		layout = cls.cache[instance.__class__] = StructLayout(instance)
+		return layout
+	add = classmethod(add)
+	
+	def newValues(self):
+		values = self.values.copy()
+		for name in self.arrays:
+			values[name] = list(values[name])
+		return values
+
 class Struct(object):
-	__slots__ = ('__attrs__', '__baked__', '__defs__', '__endian__', '__next__', '__sizes__', '__values__')
+	__slots__ = ('__attrs__', '__baked__', '__defs__', '__endian__', '__layout__', '__next__', '__sizes__', '__values__')
 	int8 = StructType(('b', 1))
 	uint8 = StructType(('B', 1))
 	
@@ -37,22 +86,35 @@ class Struct(object):
 	__endian__ = '<'
 	
 	def __init__(self, func=None, unpack=None, **kwargs):
-		self.__defs__ = []
-		self.__sizes__ = []
-		self.__attrs__ = []
-		self.__values__ = {}
-		self.__next__ = True
-		self.__baked__ = False
-		
+		layout = None
 		if func == None:
-			self.__format__()
+			layout = StructLayout.get(self.__class__)
+		
+		if layout != None:
+			object.__setattr__(self, '__defs__', layout.defs)
+			object.__setattr__(self, '__sizes__', layout.sizes)
+			object.__setattr__(self, '__attrs__', layout.attrs)
+			object.__setattr__(self, '__values__', layout.newValues())
+			object.__setattr__(self, '__next__', False)
 		else:
-			sys.settrace(self.__trace__)
-			func()
-			for name in func.func_code.co_varnames:
-				value = self.__frame__.f_locals[name]
-				self.__setattr__(name, value)
+			self.__defs__ = []
+			self.__sizes__ = []
+			self.__attrs__ = []
+			self.__values__ = {}
+			self.__next__ = True
+			self.__baked__ = False
+			
+			if func == None:
+				self.__format__()
+				layout = StructLayout.add(self)
+			else:
+				sys.settrace(self.__trace__)
+				func()
+				for name in func.func_code.co_varnames:
+					value = self.__frame__.f_locals[name]
+					self.__setattr__(name, value)
 		
+		self.__layout__ = layout
 		self.__baked__ = True
 		
 		if unpack != None:
@@ -142,6 +204,9 @@ class Struct(object):
 				raise AttributeError(name)
 	
 	def __len__(self):
+		if self.__layout__ != None and self.__layout__.struct != None:
+			return self.__layout__.struct.size
+		
 		ret = 0
 		arraypos, arrayname = None, None
 		
@@ -165,6 +230,17 @@ class Struct(object):
 		return ret
 	
 	def unpack(self, data, pos=0):
+		layout = self.__layout__
+		if layout != None and layout.struct != None:
+			values = layout.struct.unpack_from(data, pos)
+			target = self.__values__
+			for name, start, end, isArray in layout.fields:
+				if isArray:
+					target[name] = list(values[start:end])
+				else:
+					target[name] = values[start]
+			return self
+		
 		for name in self.__values__:
 			if not isinstance(self.__values__[name], Struct):
 				self.__values__[name] = None
@@ -229,6 +305,16 @@ class Struct(object):
 		return self
 	
 	def pack(self):
+		layout = self.__layout__
+		if layout != None and layout.struct != None:
+			values = []
+			for name, start, end, isArray in layout.fields:
+				if isArray:
+					values.extend(self.__values__[name][:end - start])
+				else:
+					values.append(self.__values__[name])
+			return layout.struct.pack(*values)
+		
 		arraypos, arrayname = None, None
 		
 		ret = ''
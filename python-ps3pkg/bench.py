@@ -0,0 +1,312 @@
+#!/usr/bin/env python2
+from __future__ import with_statement
+import sys
+import os
+import time
+import getopt
+import json
+import shutil
+import struct
+import tempfile
+import subprocess
+
+import pkg
+import sfo
+from fself import SelfHeader, AppInfo, DigestSubHeader
+
+CONTENTID = "UP0001-BENCH0000_00-0000000000000000"
+
+# Runs pkg.py in a child process, with pkgcrypt hidden for the python engine.
+# The peak RSS is written to a file on exit. ru_maxrss of the child as seen by
+# bench.py also counts the pages it inherited from bench.py before the exec,
+# VmHWM only covers the address space of pkg.py.
+RUNNER = """
+import os, sys, runpy, atexit, resource
+def peak(name):
+	rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	if os.path.exists("/proc/self/status"):
+		for line in open("/proc/self/status"):
+			if line.startswith("VmHWM:"):
+				rss = max(rss, int(line.split()[1]))
+	else:
+		rss = max(rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+	open(name, "w").write(str(rss))
+atexit.register(peak, sys.argv[2])
+class BlockPkgcrypt(object):
+	def find_module(self, name, path=None):
+		if name == "pkgcrypt":
+			return self
+	def load_module(self, name):
+		raise ImportError("pkgcrypt disabled by bench.py")
+if sys.argv[1] == "python":
+	sys.meta_path.insert(0, BlockPkgcrypt())
+sys.path.insert(0, os.path.dirname(sys.argv[3]))
+sys.argv = sys.argv[3:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+def timed(func, *args):
+	start = time.time()
+	ret = func(*args)
+	return time.time() - start, ret
+
+def result(name, engine, size, seconds):
+	out = {"name": name, "engine": engine, "bytes": size, "seconds": seconds}
+	if seconds > 0:
+		out["MBps"] = size / seconds / 1e6
+	return out
+
+def benchCrypt(size):
+	data = os.urandom(size)
+	key = pkg.keyToContext("0123456789abcdef")
+	results = []
+
+	seconds, python = timed(pkg.cryptFallback, pkg.listToString(key[0:0x38]), 0, data, size)
+	results.append(result("crypt", "python", size, seconds))
+
+	if 'pkgcrypt' in sys.modules:
+		seconds, native = timed(pkg.pkgcrypt.pkgcrypt, pkg.listToString(key), data, size)
+		assert native == python, "C and python crypt disagree"
+		results.append(result("crypt", "C", size, seconds))
+	return results
+
+def benchStruct(count):
+	"""Creates, unpacks and packs `count` FileHeader records."""
+	fileD = pkg.FileHeader()
+	fileD.fileNameOff = 0x20
+	fileD.fileNameLength = 9
+	fileD.fileOff = 0x1000
+	fileD.fileSize = 0x12345
+	fileD.flags = pkg.TYPE_OVERWRITE_ALLOWED | pkg.TYPE_RAW
+	fileD.padding = 0
+	data = fileD.pack() * count
+	size = len(data)
+	def unpackAll():
+		return [pkg.FileHeader().unpack(data[0x20 * i:0x20 * i + 0x20]) for i in xrange(count)]
+	seconds, fileDescs = timed(unpackAll)
+	results = [result("FileHeader unpack", "python", size, seconds)]
+	seconds, packed = timed(lambda: ''.join(fileD.pack() for fileD in fileDescs))
+	assert packed == data, "FileHeader pack does not round trip"
+	results.append(result("FileHeader pack", "python", size, seconds))
+	return results
+
+def writeRandom(path, size):
+	with open(path, 'wb') as fp:
+		while size > 0:
+			fp.write(os.urandom(min(size, 1 << 20)))
+			size -= min(size, 1 << 20)
+
+def writeEboot(path, size):
+	"""Writes a fake NPDRM SELF: SCE header, AppInfo of type 8 and a type 2
+	digest block followed by the type 3 block pkg.py puts the EbootMeta in."""
+	header = SelfHeader()
+	header.magic = 0x53434500
+	header.headerVer = 2
+	header.flags = 0x8000
+	header.AppInfo = len(header)
+	header.digest = 0x100
+	header.digestSize = 0x40 + 0x90
+	for name in ("type", "meta", "headerSize", "encryptedSize", "unknown", "elf", "phdr", "shdr", "phdrOffsets", "sceversion"):
+		setattr(header, name, 0)
+	appInfo = AppInfo()
+	appInfo.authid = 0x1010000001000003
+	appInfo.unknown = 0x01000002
+	appInfo.appType = 8
+	appInfo.appVersion = 0x0001000000000000
+	digest2 = DigestSubHeader()
+	digest2.type = 2
+	digest2.size = 0x40
+	digest2.cont = 1
+	digest3 = DigestSubHeader()
+	digest3.type = 3
+	digest3.size = 0x90
+	digest3.cont = 0
+	data = header.pack() + appInfo.pack()
+	data += '\0' * (header.digest - len(data))
+	data += digest2.pack() + os.urandom(0x30) + digest3.pack() + '\0' * 0x80
+	with open(path, 'wb') as fp:
+		fp.write(data)
+		fp.write(os.urandom(max(0, size - len(data))))
+
+def writeSFO(path):
+	xml = path + ".xml"
+	with open(xml, 'wb') as fp:
+		fp.write("""<?xml version="1.0" ?>
+<sfo>
+	<value name="APP_VER" type="string">01.00</value>
+	<value name="ATTRIBUTE" type="integer">0</value>
+	<value name="CATEGORY" type="string">HG</value>
+	<value name="TITLE" type="string">Benchmark</value>
+	<value name="TITLE_ID" type="string">%s</value>
+	<value name="VERSION" type="string">01.00</value>
+</sfo>""" % CONTENTID[7:16])
+	sfo.convertToSFO(xml, path, None, None)
+	os.remove(xml)
+
+def makeGame(directory, tiny, tinySize, huge, hugeSize, ebootSize):
+	"""Creates a synthetic game directory and returns its size in bytes."""
+	os.makedirs(os.path.join(directory, "USRDIR", "data"))
+	writeSFO(os.path.join(directory, "PARAM.SFO"))
+	writeRandom(os.path.join(directory, "ICON0.PNG"), 0x8000)
+	writeEboot(os.path.join(directory, "USRDIR", "EBOOT.BIN"), ebootSize)
+	for i in range(0, huge):
+		writeRandom(os.path.join(directory, "USRDIR", "huge%d.bin" % i), hugeSize)
+	for i in range(0, tiny):
+		sub = os.path.join(directory, "USRDIR", "data", "%02x" % (i % 256))
+		if not os.path.isdir(sub):
+			os.mkdir(sub)
+		writeRandom(os.path.join(sub, "%05d.dat" % i), tinySize)
+	return dirSize(directory)
+
+def dirSize(directory):
+	size = 0
+	for root, dirs, names in os.walk(directory):
+		for name in names:
+			size += os.path.getsize(os.path.join(root, name))
+	return size
+
+def runPkg(name, engine, size, args, cwd):
+	"""Runs pkg.py in a child process and records wall time and peak RSS."""
+	script = os.path.join(os.path.dirname(os.path.abspath(pkg.__file__)), "pkg.py")
+	fd, rssName = tempfile.mkstemp(suffix=".rss")
+	os.close(fd)
+	try:
+		with open(os.devnull, 'wb') as null:
+			start = time.time()
+			status = subprocess.call([sys.executable, "-c", RUNNER, engine, rssName, script] + args,
+				cwd=cwd, stdout=null, stderr=null)
+			seconds = time.time() - start
+		with open(rssName) as fp:
+			rss = fp.read()
+	finally:
+		os.remove(rssName)
+	res = result(name, engine, size, seconds)
+	if rss:
+		res["maxrssKB"] = int(rss)
+	res["status"] = status
+	return res
+
+def benchPkg(workdir, engines, jobs, tiny, tinySize, huge, hugeSize, ebootSize):
+	game = os.path.join(workdir, "game")
+	size = makeGame(game, tiny, tinySize, huge, hugeSize, ebootSize)
+	single = "USRDIR/EBOOT.BIN"
+	singleSize = os.path.getsize(os.path.join(game, "USRDIR", "EBOOT.BIN"))
+	if huge > 0:
+		single = "USRDIR/huge0.bin"
+		singleSize = hugeSize
+	results = []
+	packages = []
+	for engine in engines:
+		out = os.path.join(workdir, "%s.pkg" % engine)
+		packages.append(out)
+		jobArgs = ["-j", str(jobs)]
+		results.append(runPkg("pack", engine, size, jobArgs + ["-c", CONTENTID, game + "/", out], workdir))
+		pkgSize = os.path.getsize(out)
+		results.append(runPkg("list", engine, pkgSize, ["-l", out], workdir))
+		results.append(runPkg("extract-file", engine, singleSize, ["--extract-file", single, out, "-"], workdir))
+		extractDir = tempfile.mkdtemp(dir=workdir)
+		results.append(runPkg("extract", engine, size, jobArgs + ["-x", out], extractDir))
+		shutil.rmtree(extractDir)
+	for out in packages[1:]:
+		with open(packages[0], 'rb') as a:
+			with open(out, 'rb') as b:
+				assert a.read() == b.read(), "%s and %s differ" % (packages[0], out)
+	return results
+
+def printResults(results):
+	for res in results:
+		out = "%-24s %-8s %12d bytes %9.3fs" % (res["name"], res["engine"], res["bytes"], res["seconds"])
+		if "MBps" in res:
+			out += " %9.2f MB/s" % res["MBps"]
+		if "maxrssKB" in res:
+			out += " %9d KB" % res["maxrssKB"]
+		if res.get("status"):
+			out += " FAILED (%d)" % res["status"]
+		print out
+
+def usage():
+	print """usage:
+    python bench.py [options]
+        -s | --size             bytes to encrypt (default 16 MiB).
+        -o | --output           write results as JSON to this file.
+        --structs               number of FileHeader records (default 100000).
+        --tiny                  number of tiny files (default 2000).
+        --tiny-size             size of a tiny file (default 1024).
+        --huge                  number of huge files (default 2).
+        --huge-size             size of a huge file (default 8 MiB).
+        --eboot-size            size of the fake EBOOT.BIN (default 1 MiB).
+        --engines               crypt engines to run pkg.py with (default C,python).
+        -j | --jobs             workers passed to pkg.py (default 1).
+        --no-pkg                only benchmark the cipher.
+        --keep                  keep the work directory."""
+
+def main():
+	size = 16 << 20
+	output = None
+	tiny = 2000
+	tinySize = 1024
+	huge = 2
+	hugeSize = 8 << 20
+	ebootSize = 1 << 20
+	engines = ["C", "python"]
+	jobs = 1
+	benchPkgs = True
+	keep = False
+	structs = 100000
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hs:o:j:", ["help", "size=", "output=", "tiny=", "tiny-size=", "huge=", "huge-size=", "eboot-size=", "engines=", "jobs=", "no-pkg", "keep", "structs="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt in ("-h", "--help"):
+			usage()
+			sys.exit(2)
+		elif opt in ("-s", "--size"):
+			size = int(arg, 0)
+		elif opt in ("-o", "--output"):
+			output = arg
+		elif opt == "--tiny":
+			tiny = int(arg, 0)
+		elif opt == "--tiny-size":
+			tinySize = int(arg, 0)
+		elif opt == "--huge":
+			huge = int(arg, 0)
+		elif opt == "--huge-size":
+			hugeSize = int(arg, 0)
+		elif opt == "--eboot-size":
+			ebootSize = int(arg, 0)
+		elif opt == "--engines":
+			engines = arg.split(",")
+		elif opt in ("-j", "--jobs"):
+			jobs = int(arg)
+		elif opt == "--no-pkg":
+			benchPkgs = False
+		elif opt == "--keep":
+			keep = True
+		elif opt == "--structs":
+			structs = int(arg, 0)
+	if 'pkgcrypt' not in sys.modules and "C" in engines:
+		print >> sys.stderr, "pkgcrypt is not built, skipping the C engine."
+		engines.remove("C")
+
+	results = benchCrypt(size) + benchStruct(structs)
+	printResults(results)
+	if benchPkgs:
+		workdir = tempfile.mkdtemp(prefix="pkgbench")
+		try:
+			pkgResults = benchPkg(workdir, engines, jobs, tiny, tinySize, huge, hugeSize, ebootSize)
+		finally:
+			if keep:
+				print >> sys.stderr, "work directory: %s" % workdir
+			else:
+				shutil.rmtree(workdir)
+		printResults(pkgResults)
+		results += pkgResults
+	if output != None:
+		config = {"size": size, "structs": structs, "tiny": tiny, "tinySize": tinySize, "huge": huge, "hugeSize": hugeSize,
+			"ebootSize": ebootSize, "engines": engines, "jobs": jobs}
+		with open(output, "w") as fp:
+			json.dump({"time": time.time(), "config": config, "results": results}, fp, indent=1)
+if __name__ == "__main__":
+	main()
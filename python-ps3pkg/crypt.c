@@ -19,75 +19,79 @@
  * THE SOFTWARE.
  */
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
+#include <stdint.h>
 
+#include "sha1.h"
+
+/* Only kept so older pkg.py versions can still register their callback,
+ * the keystream is computed with the bundled SHA-1 implementation. */
 static PyObject *sha1_callback = NULL;
 
-static void manipulate(uint8_t *key)
+/* The key is 0x38 constant bytes followed by a 64 bit big endian block
+ * counter, every 16 byte block is xored with the first 16 bytes of the
+ * SHA-1 of the key, then the counter is incremented. */
+static void crypt_buffer(const uint8_t *key, const uint8_t *input, uint8_t *output, Py_ssize_t length)
 {
-   uint64_t temp = key[0x38] << 56| 
-      key[0x39] << 48|
-      key[0x3a] << 40|
-      key[0x3b] << 32|
-      key[0x3c] << 24|
-      key[0x3d] << 16|
-      key[0x3e] <<  8|
-      key[0x3f];
-   temp++;
-   key[0x38] = (temp >> 56) & 0xff;
-   key[0x39] = (temp >> 48) & 0xff;
-   key[0x3a] = (temp >> 40) & 0xff;
-   key[0x3b] = (temp >> 32) & 0xff;
-   key[0x3c] = (temp >> 24) & 0xff;
-   key[0x3d] = (temp >> 16) & 0xff;
-   key[0x3e] = (temp >>  8) & 0xff;
-   key[0x3f] = (temp >>  0) & 0xff;
+   sha1_context prefix, ctx;
+   uint8_t counter[8], hash[20];
+   uint64_t num = 0;
+   Py_ssize_t offset;
+   int i;
+
+   for (i = 0; i < 8; i++)
+      num = (num << 8) | key[0x38 + i];
+
+   sha1_starts(&prefix);
+   sha1_update(&prefix, key, 0x38);
+
+   for (offset = 0; offset < length; offset += 0x10)
+   {
+      int bytes_to_dump = length - offset > 0x10 ? 0x10 : (int)(length - offset);
+
+      for (i = 0; i < 8; i++)
+         counter[i] = (num >> (56 - 8 * i)) & 0xff;
+      ctx = prefix;
+      sha1_update(&ctx, counter, 8);
+      sha1_finish(&ctx, hash);
+
+      for (i = 0; i < bytes_to_dump; i++)
+         output[offset + i] = hash[i] ^ input[offset + i];
+      num++;
+   }
 }
 
 static PyObject* pkg_crypt(PyObject *self, PyObject *args)
 {
-   uint8_t *key, *input, *ret;
-   int key_length, input_length, length;
-   int remaining, i, offset=0;
-
-   PyObject *arglist;
-   PyObject *result;
+   const uint8_t *key, *input;
+   Py_ssize_t key_length, input_length, length;
+   PyObject *ret;
 
-   if (!PyArg_ParseTuple(args, "s#s#i", &key, &key_length, &input, &input_length, &length))
+   if (!PyArg_ParseTuple(args, "s#s#n", &key, &key_length, &input, &input_length, &length))
       return NULL;
-   ret       = malloc(length);
-   remaining = length;
-
-   while (remaining > 0)
+   if (key_length < 0x40)
    {
-      int outHash_length;
-      uint8_t *outHash; 
-      int bytes_to_dump = remaining;
-      if (bytes_to_dump > 0x10) 
-         bytes_to_dump = 0x10;
-
-      arglist = Py_BuildValue("(s#)", key, 0x40);
-      result  = PyObject_CallObject(sha1_callback, arglist);
-      Py_DECREF(arglist);
-      if (!result)
-         return NULL;
-      if (!PyArg_Parse(result, "s#", &outHash, &outHash_length))
-         return NULL;
-
-      for(i = 0; i < bytes_to_dump; i++)
-      {
-         ret[offset] = outHash[i] ^ input[offset];
-         offset++;
-      }
-      Py_DECREF(result);
-      manipulate(key);
-      remaining -= bytes_to_dump;
+      PyErr_SetString(PyExc_ValueError, "key must be 0x40 bytes");
+      return NULL;
    }
+   if (length < 0 || length > input_length)
+   {
+      PyErr_SetString(PyExc_ValueError, "length exceeds input");
+      return NULL;
+   }
+
+   ret = PyString_FromStringAndSize(NULL, length);
+   if (!ret)
+      return NULL;
+
+   /* key and input belong to the argument tuple and ret is not shared yet,
+    * so other threads can run while the buffer is processed */
+   Py_BEGIN_ALLOW_THREADS
+   crypt_buffer(key, input, (uint8_t *)PyString_AS_STRING(ret), length);
+   Py_END_ALLOW_THREADS
 
-   /* Return the encrypted data */
-   PyObject *py_ret = Py_BuildValue("s#", ret, length);
-   free(ret);
-   return py_ret;
+   return ret;
 }
 
 static PyObject *register_sha1_callback(PyObject *self, PyObject *args)
@@ -113,8 +117,8 @@ static PyObject *register_sha1_callback(PyObject *self, PyObject *args)
 }
 
 static PyMethodDef cryptMethods[] = {
-	{"pkgcrypt", pkg_crypt, METH_VARARGS, "C implementation of pkg.py's crypt function"},
-	{"register_sha1_callback", register_sha1_callback, METH_VARARGS, "Register a callback to python's SHA1 function, so we don't have to bother with creating our own implementation."},
+	{"pkgcrypt", pkg_crypt, METH_VARARGS, "C implementation of pkg.py's crypt function, releases the GIL while processing"},
+	{"register_sha1_callback", register_sha1_callback, METH_VARARGS, "Obsolete, SHA-1 is computed natively. Kept for compatibility with older pkg.py versions."},
 	{NULL, NULL, 0, NULL}
 };
 
@@ -2,6 +2,7 @@
 from __future__ import with_statement
 from Struct import Struct
 from fself import SelfHeader, AppInfo
+from sfo import parseSFO
 
 import struct
 import sys
@@ -11,6 +12,23 @@ import getopt
 import ConfigParser
 import io
 import glob
+import json
+import tarfile
+import posixpath
+import zipfile
+import gzip
+import bz2
+import shutil
+import tempfile
+import time
+import binascii
+import bisect
+import zlib
+import atexit
+import threading
+import collections
+import multiprocessing
+import multiprocessing.pool
 
 def SHA1(data):
 	m = hashlib.sha1()
@@ -21,13 +39,13 @@ try:
 	import pkgcrypt
 	pkgcrypt.register_sha1_callback(SHA1)
 except:
-	print "Failed to import pkgcrypt. Falling back to slow crypt implementation."
-	print "To fix, run:"
-	print ""
-	print "python2 setup.py build"
-	print ""
-	print "This should create a pkgcrypt.so file in the build/ directory. Move that file"
-	print "over to the root of the ps3py directory and try running this script again."
+	print >> sys.stderr, "Failed to import pkgcrypt. Falling back to slow crypt implementation."
+	print >> sys.stderr, "To fix, run:"
+	print >> sys.stderr, ""
+	print >> sys.stderr, "python2 setup.py build"
+	print >> sys.stderr, ""
+	print >> sys.stderr, "This should create a pkgcrypt.so file in the build/ directory. Move that file"
+	print >> sys.stderr, "over to the root of the ps3py directory and try running this script again."
 
 TYPE_NPDRMSELF = 0x1
 TYPE_RAW = 0x3
@@ -36,6 +54,57 @@ TYPE_DIRECTORY = 0x4
 TYPE_OVERWRITE_ALLOWED = 0x80000000
 
 debug = False
+jobs = multiprocessing.cpu_count()
+
+# Files up to SMALL_FILE bytes are extracted through a pool of WRITERS
+# threads, with at most WRITE_WINDOW of them pending.
+SMALL_FILE = 0x10000
+WRITERS = 4
+WRITE_WINDOW = 64
+
+# Set by --profile, every stage checks it before taking the time.
+profiler = None
+
+class Profiler(object):
+	"""Accumulates time, bytes and calls per stage and optionally keeps every
+	measurement as a trace event. Stages may nest (e.g. crypt within table)."""
+	def __init__(self, trace=False):
+		self.stages = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.events = None
+		if trace:
+			self.events = []
+		self.start = time.time()
+	def add(self, stage, start, size=0):
+		end = time.time()
+		with self.lock:
+			entry = self.stages.setdefault(stage, [0.0, 0, 0])
+			entry[0] += end - start
+			entry[1] += size
+			entry[2] += 1
+			if self.events != None:
+				self.events.append({"name": stage, "ph": "X", "pid": os.getpid(),
+					"tid": threading.current_thread().ident, "ts": (start - self.start) * 1e6,
+					"dur": (end - start) * 1e6, "args": {"bytes": size}})
+	def report(self):
+		print >> sys.stderr, "%-8s %10s %14s %10s %10s" % ("stage", "calls", "bytes", "seconds", "MB/s")
+		for stage, (seconds, size, calls) in self.stages.items():
+			out = "%-8s %10d %14d %10.3f" % (stage, calls, size, seconds)
+			if size and seconds > 0:
+				out += " %10.2f" % (size / seconds / 1e6)
+			print >> sys.stderr, out
+		print >> sys.stderr, "%-8s %10s %14s %10.3f" % ("total", "", "", time.time() - self.start)
+	def dumpTrace(self, filename):
+		with open(filename, 'wb') as fp:
+			json.dump({"traceEvents": self.events}, fp)
+
+def finishProfile(cprof, cprofileName, traceName):
+	if cprof != None:
+		cprof.disable()
+		cprof.dump_stats(cprofileName)
+	profiler.report()
+	if traceName != None:
+		profiler.dumpTrace(traceName)
 
 class EbootMeta(Struct):
 	__endian__ = Struct.BE
@@ -127,6 +196,16 @@ class FileHeader(Struct):
 			self.fileName = nullterm(decrypteddata[self.fileNameOff:self.fileNameOff+self.fileNameLength])
 		else:
 			self.fileName = nullterm(crypt(context, decrypteddata[self.fileNameOff:self.fileNameOff+self.fileNameLength], self.fileNameLength))
+	def write(self, directory, data):
+		"""Writes `data`, a string or memoryview, to the file preallocated to
+		fileSize."""
+		if profiler:
+			start = time.time()
+		with open(directory + "/" + self.fileName, "wb") as tFile:
+			tFile.truncate(self.fileSize)
+			tFile.write(data)
+		if profiler:
+			profiler.add("write", start, len(data))
 	def dump(self, directory, data, header):
 		if self.flags & 0xFF == 0x4:
 			try:
@@ -135,8 +214,24 @@ class FileHeader(Struct):
 				print
 
 		else:
-			tFile = open(directory + "/" + self.fileName, "wb")
-			tFile.write(data[self.fileOff:self.fileOff+self.fileSize])
+			self.write(directory, memoryview(data)[self.fileOff:self.fileOff+self.fileSize])
+	def extract(self, directory, fp, header, pool=None, jobs=1, writers=None):
+		"""Streams the file out of the package. Small files are handed to the
+		`writers` pool, the AsyncResult of the write is returned then."""
+		if self.flags & 0xFF == TYPE_DIRECTORY:
+			self.dump(directory, None, header)
+		elif writers != None and self.fileSize <= SMALL_FILE:
+			data = ''.join(decryptRange(fp, header, self.fileOff, self.fileSize))
+			return writers.apply_async(self.write, (directory, data))
+		else:
+			with open(directory + "/" + self.fileName, "wb") as tFile:
+				tFile.truncate(self.fileSize)
+				for chunk in decryptRange(fp, header, self.fileOff, self.fileSize, pool, jobs):
+					if profiler:
+						start = time.time()
+					tFile.write(chunk)
+					if profiler:
+						profiler.add("write", start, len(chunk))
 
 
 class Header(Struct):
@@ -224,13 +319,9 @@ def keyToContext(key):
 def manipulate(key):
 	if not isinstance(key, list):
 		return
-	tmp = listToString(key[0x38:])
-
-
-	tmpnum = struct.unpack('>Q', tmp)[0]
-	tmpnum += 1
-	tmpnum = tmpnum & 0xFFFFFFFFFFFFFFFF
-	setContextNum(key, tmpnum)
+	setContextNum(key, (getContextNum(key) + 1) & 0xFFFFFFFFFFFFFFFF)
+def getContextNum(key):
+	return struct.unpack('>Q', listToString(key[0x38:0x40]))[0]
 def setContextNum(key, tmpnum):
 	tmpchrs = struct.pack('>Q', tmpnum)
 
@@ -243,51 +334,357 @@ def setContextNum(key, tmpnum):
 	key[0x3e] = ord(tmpchrs[6])
 	key[0x3f] = ord(tmpchrs[7])
 
+# Size of the keystream generated and xored in one go by the python fallback.
+CRYPT_BATCH = 0x10000
+packCounter = struct.Struct('>Q').pack
+
+def keystream(prefix, counter, blocks):
+	"""Returns the keystream of `blocks` 16 byte blocks, starting at `counter`.
+	The SHA1 state of the constant first 0x38 bytes of the key is reused."""
+	base = hashlib.sha1(prefix)
+	out = []
+	for i in xrange(blocks):
+		m = base.copy()
+		m.update(packCounter((counter + i) & 0xFFFFFFFFFFFFFFFF))
+		out.append(m.digest()[0:0x10])
+	return ''.join(out)
+
+def xorString(a, b):
+	if len(a) == 0:
+		return ""
+	num = int(binascii.hexlify(a), 16) ^ int(binascii.hexlify(b), 16)
+	return binascii.unhexlify('%0*x' % (len(a) * 2, num))
+
+def cryptFallback(prefix, counter, inbuf, length):
+	ret = bytearray(length)
+	for offset in xrange(0, length, CRYPT_BATCH):
+		size = min(CRYPT_BATCH, length - offset)
+		stream = keystream(prefix, counter + offset / 0x10, (size + 0x0F) / 0x10)
+		ret[offset:offset+size] = xorString(inbuf[offset:offset+size], stream[0:size])
+	return str(ret)
+
+def cryptAt(prefix, counter, inbuf, length):
+	if profiler:
+		start = time.time()
+	if 'pkgcrypt' in sys.modules:
+		ret = pkgcrypt.pkgcrypt(prefix + packCounter(counter & 0xFFFFFFFFFFFFFFFF), inbuf, length);
+	else:
+		ret = cryptFallback(prefix, counter, inbuf, length)
+	if profiler:
+		profiler.add("crypt", start, length)
+	return ret
+
 def crypt(key, inbuf, length):
 	if not isinstance(key, list):
 		return ""
+	counter = getContextNum(key)
+	ret = cryptAt(listToString(key[0:0x38]), counter, inbuf, length)
+	setContextNum(key, (counter + (length + 0x0F) / 0x10) & 0xFFFFFFFFFFFFFFFF)
+	return ret
+
+# Every PARALLEL_CHUNK bytes of a buffer are handed to a worker on their own,
+# starting with the counter of their first block.
+PARALLEL_CHUNK = 0x100000
+
+def cryptChunk(args):
+	prefix, counter, inbuf = args
+	return cryptAt(prefix, counter, inbuf, len(inbuf))
+
+def cryptPool(jobs):
+	# pkgcrypt releases the GIL, the python fallback needs processes
 	if 'pkgcrypt' in sys.modules:
-		return pkgcrypt.pkgcrypt(listToString(key), inbuf, length);
-	ret = ""
-	offset = 0
-	while length > 0:
-		bytes_to_dump = length
-		if length > 0x10:
-			bytes_to_dump = 0x10
-		outhash = SHA1(listToString(key)[0:0x40])
-		for i in range(0, bytes_to_dump):
-			ret += chr(ord(outhash[i]) ^ ord(inbuf[offset]))
-			offset += 1
-		manipulate(key)
-		length -= bytes_to_dump
+		return multiprocessing.pool.ThreadPool(jobs)
+	return multiprocessing.Pool(jobs)
+
+def orderedMap(pool, func, iterable, window):
+	"""Like pool.imap, but only keeps `window` items in flight so that the
+	input can be a stream."""
+	pending = collections.deque()
+	for item in iterable:
+		pending.append(pool.apply_async(func, (item,)))
+		if len(pending) >= window:
+			yield pending.popleft().get()
+	while pending:
+		yield pending.popleft().get()
+
+def cryptParallel(key, inbuf, length, jobs):
+	if not isinstance(key, list):
+		return ""
+	if jobs <= 1 or length <= PARALLEL_CHUNK:
+		return crypt(key, inbuf, length)
+	counter = getContextNum(key)
+	prefix = listToString(key[0:0x38])
+	chunks = ((prefix, counter + offset / 0x10, inbuf[offset:min(offset + PARALLEL_CHUNK, length)])
+		for offset in xrange(0, length, PARALLEL_CHUNK))
+	pool = cryptPool(jobs)
+	try:
+		ret = ''.join(orderedMap(pool, cryptChunk, chunks, jobs * 2))
+	finally:
+		pool.terminate()
+	setContextNum(key, (counter + (length + 0x0F) / 0x10) & 0xFFFFFFFFFFFFFFFF)
 	return ret
 
-def listPkg(filename):
-	with open(filename, 'rb') as fp:
-		data = fp.read()
-		offset = 0
-		header = Header()
-		header.unpack(data[offset:offset+len(header)])
+# Split packages are stored as name.66600, name.66601, ... parts of at most
+# SPLIT_SIZE bytes, so that they fit on FAT32.
+SPLIT_FIRST = 66600
+SPLIT_SIZE = 0xFFFF0000
+
+def splitParts(name):
+	"""Returns the existing parts of the split package `name`, which may be
+	given with or without the suffix of the first part."""
+	if name.endswith(".%d" % SPLIT_FIRST):
+		name = name[:-len(".%d" % SPLIT_FIRST)]
+	parts = []
+	while os.path.exists("%s.%d" % (name, SPLIT_FIRST + len(parts))):
+		parts.append("%s.%d" % (name, SPLIT_FIRST + len(parts)))
+	return parts
+
+class SplitFile(object):
+	"""One virtual file over the parts of a split package."""
+	def __init__(self, parts, mode='rb'):
+		self.parts = parts
+		self.mode = mode
+		self.sizes = [os.path.getsize(part) for part in parts]
+		self.starts = []
+		self.size = 0
+		for size in self.sizes:
+			self.starts.append(self.size)
+			self.size += size
+		self.fps = {}
+		self.pos = 0
+	@staticmethod
+	def create(name, size, partSize):
+		"""Creates the parts for a package of `size` bytes, removing stale
+		parts of an older, larger package."""
+		count = max(1, (size + partSize - 1) / partSize)
+		for part in splitParts(name)[count:]:
+			os.remove(part)
+		parts = []
+		for i in range(0, count):
+			parts.append("%s.%d" % (name, SPLIT_FIRST + i))
+			with open(parts[-1], 'wb') as fp:
+				fp.truncate(min(partSize, size - i * partSize))
+		return SplitFile(parts, 'r+b')
+	def part(self, index):
+		if index not in self.fps:
+			self.fps[index] = open(self.parts[index], self.mode)
+		return self.fps[index]
+	def read(self, size=-1):
+		if size < 0:
+			size = self.size - self.pos
+		out = []
+		while size > 0 and self.pos < self.size:
+			index = bisect.bisect_right(self.starts, self.pos) - 1
+			fp = self.part(index)
+			fp.seek(self.pos - self.starts[index])
+			data = fp.read(min(size, self.starts[index] + self.sizes[index] - self.pos))
+			if len(data) == 0:
+				break
+			out.append(data)
+			self.pos += len(data)
+			size -= len(data)
+		return ''.join(out)
+	def write(self, data):
+		data = memoryview(data)
+		written = 0
+		while written < len(data):
+			if self.pos >= self.size:
+				raise IOError("Write beyond the end of %s" % self.parts[-1])
+			index = bisect.bisect_right(self.starts, self.pos) - 1
+			size = min(len(data) - written, self.starts[index] + self.sizes[index] - self.pos)
+			fp = self.part(index)
+			fp.seek(self.pos - self.starts[index])
+			fp.write(data[written:written+size])
+			written += size
+			self.pos += size
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self.pos
+		elif whence == 2:
+			offset += self.size
+		if offset < 0:
+			raise IOError("Invalid offset %d" % offset)
+		self.pos = offset
+	def tell(self):
+		return self.pos
+	def fileno(self):
+		return self.part(0).fileno()
+	def close(self):
+		for fp in self.fps.values():
+			fp.close()
+		self.fps = {}
+	def __enter__(self):
+		return self
+	def __exit__(self, *args):
+		self.close()
+
+def openPkg(filename, mode='rb'):
+	"""Opens a package, a split package is opened by the name of the whole
+	package or of its first part."""
+	parts = splitParts(filename)
+	if os.path.exists(filename) and not filename.endswith(".%d" % SPLIT_FIRST):
+		if len(parts) != 0:
+			raise IOError("Both %s and its split parts exist" % filename)
+		return open(filename, mode)
+	if len(parts) == 0:
+		return open(filename, mode)
+	return SplitFile(parts, mode)
+
+def createPkg(outname, size, splitSize=None):
+	"""Creates the output package, split or not, and removes what is left of
+	the same package in the other format."""
+	if splitSize != None:
+		if os.path.exists(outname):
+			os.remove(outname)
+		return SplitFile.create(outname, size, splitSize)
+	for part in splitParts(outname):
+		os.remove(part)
+	return open(outname, 'wb')
+
+def openOutput(outname, splitSize=None):
+	if splitSize != None:
+		return SplitFile(splitParts(outname), 'r+b')
+	return open(outname, 'r+b')
+
+def readHeader(fp):
+	header = Header()
+	fp.seek(0)
+	header.unpack(fp.read(len(header)))
+	return header
+
+def readMetaHeader(fp, header):
+	metaBlock = MetaHeader()
+	fp.seek(header.pkgInfoOff)
+	metaBlock.unpack(fp.read(len(metaBlock)))
+	return metaBlock
+
+def readFileTable(fp, header, jobs=1):
+	"""Decrypts only the file table and the file names following it."""
+	context = keyToContext(header.QADigest)
+	tableSize = len(FileHeader())*header.itemCount
+	fp.seek(header.dataOff)
+	decData = cryptParallel(context, fp.read(tableSize), tableSize, jobs)
+	fileDescs = []
+	namesEnd = tableSize
+	if profiler:
+		start = time.time()
+	for i in range(0, header.itemCount):
+		fileD = FileHeader()
+		fileD.unpack(decData[0x20 * i:0x20 * i + 0x20])
+		fileDescs.append(fileD)
+		namesEnd = max(namesEnd, fileD.fileNameOff + fileD.fileNameLength)
+	if profiler:
+		profiler.add("struct", start, tableSize)
+	decData += cryptParallel(context, fp.read(namesEnd - tableSize), namesEnd - tableSize, jobs)
+	for fileD in fileDescs:
+		fileD.doWork(decData)
+	return fileDescs
+
+def decryptRange(fp, header, offset, size, pool=None, jobs=1):
+	"""Yields the decrypted data of `size` bytes at `offset` into the data
+	section in chunks of at most PARALLEL_CHUNK bytes. Only the requested range
+	is read, with a pool up to 2 * jobs chunks are kept in memory."""
+	prefix = listToString(keyToContext(header.QADigest)[0:0x38])
+	skip = offset % 0x10
+	def chunks():
+		pos = offset - skip
+		end = offset + size
+		while pos < end:
+			if profiler:
+				start = time.time()
+			fp.seek(header.dataOff + pos)
+			data = fp.read(min(PARALLEL_CHUNK, end - pos))
+			if profiler:
+				profiler.add("read", start, len(data))
+			if len(data) == 0:
+				raise IOError("Unexpected end of package at %x" % (header.dataOff + pos))
+			yield (prefix, pos / 0x10, data)
+			pos += len(data)
+	if pool == None:
+		decrypted = (cryptChunk(chunk) for chunk in chunks())
+	else:
+		decrypted = orderedMap(pool, cryptChunk, chunks(), jobs * 2)
+	for chunk in decrypted:
+		if skip:
+			chunk = chunk[skip:]
+			skip = 0
+		yield chunk
+
+class PkgFile(object):
+	"""Read only file object for a file inside a package, decrypting only the
+	requested range on every read."""
+	def __init__(self, fp, header, fileD):
+		self.fp = fp
+		self.header = header
+		self.fileD = fileD
+		self.pos = 0
+	def read(self, size=-1):
+		remaining = max(0, self.fileD.fileSize - self.pos)
+		if size < 0 or size > remaining:
+			size = remaining
+		if size == 0:
+			return ""
+		data = ''.join(decryptRange(self.fp, self.header, self.fileD.fileOff + self.pos, size))
+		self.pos += len(data)
+		return data
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self.pos
+		elif whence == 2:
+			offset += self.fileD.fileSize
+		if offset < 0:
+			raise IOError("Invalid offset %d" % offset)
+		self.pos = offset
+	def tell(self):
+		return self.pos
+
+def fileType(fileD):
+	return {TYPE_NPDRMSELF: "npdrm-self", TYPE_DIRECTORY: "directory",
+		TYPE_RAW: "raw"}.get(fileD.flags & 0xFF, "unknown")
+
+def pkgInfo(filename, header, metaBlock, fileDescs):
+	context = keyToContext(header.QADigest)
+	setContextNum(context, 0xFFFFFFFFFFFFFFFF)
+	return {
+		"file": filename,
+		"contentID": nullterm(header.contentID),
+		"type": header.type,
+		"packageSize": header.packageSize,
+		"dataOff": header.dataOff,
+		"dataSize": header.dataSize,
+		"itemCount": header.itemCount,
+		"QADigest": listToString(header.QADigest).encode('hex'),
+		"KLicensee": crypt(context, listToString(header.KLicensee), 0x10).encode('hex'),
+		"drmType": metaBlock.drmType,
+		"contentType": metaBlock.unk22,
+		"packageType": metaBlock.unk31,
+		"files": [{
+			"name": fileD.fileName,
+			"offset": fileD.fileOff,
+			"size": fileD.fileSize,
+			"type": fileType(fileD),
+			"overwrite": (fileD.flags & TYPE_OVERWRITE_ALLOWED) != 0,
+		} for fileD in fileDescs],
+	}
+
+def listPkg(filename, jobs=1, asJson=False):
+	"""Prints header and file table, reading only the header, the metadata
+	block, the file table and the file names."""
+	with openPkg(filename) as fp:
+		header = readHeader(fp)
+		assert header.type == 0x00000001, 'Unsupported Type'
+		if asJson:
+			info = pkgInfo(filename, header, readMetaHeader(fp, header), readFileTable(fp, header, jobs))
+			print json.dumps(info, indent=1)
+			return
 		print header
 		print
 
-		assert header.type == 0x00000001, 'Unsupported Type'
 		if header.itemCount > 0:
 			print 'Listing: "' + filename + '"'
 			print "+) overwrite, -) no overwrite"
 			print
-			dataEnc = data[header.dataOff:header.dataOff+header.dataSize]
-			context = keyToContext(header.QADigest)
-
-			decData = crypt(context, dataEnc, len(FileHeader())*header.itemCount)
-
-			fileDescs = []
-			for i in range(0, header.itemCount):
-				fileD = FileHeader()
-				fileD.unpack(decData[0x20 * i:0x20 * i + 0x20])
-				fileDescs.append(fileD)
-			for fileD in fileDescs:
-				fileD.doWork(dataEnc, context)
+			for fileD in readFileTable(fp, header, jobs):
 				out = ""
 				if fileD.flags & 0xFF == TYPE_NPDRMSELF:
 					out += " NPDRM SELF:"
@@ -306,36 +703,360 @@ def listPkg(filename):
 				print out,
 				print
 				#print fileD
-def unpack(filename):
-	with open(filename, 'rb') as fp:
-		data = fp.read()
-		offset = 0
-		header = Header()
-		header.unpack(data[offset:offset+len(header)])
+def unpack(filename, jobs=1):
+	with openPkg(filename) as fp:
+		header = readHeader(fp)
 		if debug:
 			print header
 			print
 
 		assert header.type == 0x00000001, 'Unsupported Type'
 		if header.itemCount > 0:
-			dataEnc = data[header.dataOff:header.dataOff+header.dataSize]
-			context = keyToContext(header.QADigest)
-
-			decData = crypt(context, dataEnc, header.dataSize)
 			directory = nullterm(header.contentID)
 			try:
 				os.makedirs(directory)
 			except Exception, e:
 				pass
-			fileDescs = []
-			for i in range(0, header.itemCount):
-				fileD = FileHeader()
-				fileD.unpack(decData[0x20 * i:0x20 * i + 0x20])
-				fileD.doWork(decData)
-				fileDescs.append(fileD)
-				if debug:
-					print fileD
-				fileD.dump(directory, decData, header)
+			pool = None
+			if jobs > 1:
+				pool = cryptPool(jobs)
+			writers = multiprocessing.pool.ThreadPool(WRITERS)
+			try:
+				pending = collections.deque()
+				for fileD in readFileTable(fp, header):
+					if debug:
+						print fileD
+					result = fileD.extract(directory, fp, header, pool, jobs, writers)
+					if result != None:
+						pending.append(result)
+						if len(pending) >= WRITE_WINDOW:
+							pending.popleft().get()
+				while pending:
+					pending.popleft().get()
+			finally:
+				writers.terminate()
+				if pool != None:
+					pool.terminate()
+def extractToTar(filename, outname):
+	"""Writes the files of the package as a tar stream to `outname` ("-" for
+	stdout), decrypting each file while tarfile reads it."""
+	if outname == "-":
+		outFile = sys.stdout
+	else:
+		outFile = open(outname, 'wb')
+	try:
+		with openPkg(filename) as fp:
+			header = readHeader(fp)
+			assert header.type == 0x00000001, 'Unsupported Type'
+			directory = nullterm(header.contentID)
+			mtime = os.fstat(fp.fileno()).st_mtime
+			tar = tarfile.open(fileobj=outFile, mode="w|")
+			try:
+				for fileD in readFileTable(fp, header):
+					info = tarfile.TarInfo(directory + "/" + fileD.fileName)
+					info.mtime = mtime
+					if fileD.flags & 0xFF == TYPE_DIRECTORY:
+						info.type = tarfile.DIRTYPE
+						info.mode = 0755
+						tar.addfile(info)
+					else:
+						info.size = fileD.fileSize
+						info.mode = 0644
+						tar.addfile(info, PkgFile(fp, header, fileD))
+			finally:
+				tar.close()
+	finally:
+		if outFile != sys.stdout:
+			outFile.close()
+
+def findFile(fp, header, path):
+	for fileD in readFileTable(fp, header):
+		if fileD.fileName == path and fileD.flags & 0xFF != TYPE_DIRECTORY:
+			return fileD
+	raise KeyError(path)
+
+def readFile(filename, path):
+	"""Returns the contents of the file `path` inside the package. Only the
+	file table, the file names and the file itself are read and decrypted."""
+	with openPkg(filename) as fp:
+		header = readHeader(fp)
+		assert header.type == 0x00000001, 'Unsupported Type'
+		fileD = findFile(fp, header, path)
+		return ''.join(decryptRange(fp, header, fileD.fileOff, fileD.fileSize))
+
+def extractFile(filename, path, outname=None):
+	"""Like readFile, but streams the file to `outname` (default: the base
+	name of `path`, "-" for stdout)."""
+	if outname == None:
+		outname = os.path.basename(path)
+	with openPkg(filename) as fp:
+		header = readHeader(fp)
+		assert header.type == 0x00000001, 'Unsupported Type'
+		fileD = findFile(fp, header, path)
+		if outname == "-":
+			outFile = sys.stdout
+		else:
+			outFile = open(outname, 'wb')
+		try:
+			for chunk in decryptRange(fp, header, fileD.fileOff, fileD.fileSize):
+				outFile.write(chunk)
+		finally:
+			if outFile != sys.stdout:
+				outFile.close()
+
+INDEX_FILE = "pkgindex.json"
+
+def findPkgs(directory):
+	"""Yields the packages below `directory`, split packages by their first
+	part."""
+	first = ".pkg.%d" % SPLIT_FIRST
+	for root, dirs, names in os.walk(directory):
+		dirs.sort()
+		for name in sorted(names):
+			if name.lower().endswith(".pkg") or name.lower().endswith(first):
+				yield os.path.join(root, name)
+
+def pkgStat(filename):
+	"""Returns the mtime and size of a package, over all parts if it is split."""
+	parts = [filename]
+	if filename.endswith(".%d" % SPLIT_FIRST):
+		parts = splitParts(filename)
+	stats = [os.stat(part) for part in parts]
+	return max(st.st_mtime for st in stats), sum(st.st_size for st in stats)
+
+def indexPkg(filename):
+	"""Returns the catalogue entry of a package, read from its header, the
+	metadata block, the file table and PARAM.SFO only."""
+	entry = {}
+	try:
+		with openPkg(filename) as fp:
+			header = readHeader(fp)
+			if header.magic != 0x7F504B47 or header.type != 0x00000001:
+				raise ValueError("not a supported package")
+			metaBlock = readMetaHeader(fp, header)
+			entry["contentID"] = nullterm(header.contentID)
+			entry["drmType"] = metaBlock.drmType
+			entry["contentType"] = metaBlock.unk22
+			entry["packageType"] = metaBlock.unk31
+			for fileD in readFileTable(fp, header):
+				if fileD.fileName == "PARAM.SFO" and fileD.flags & 0xFF != TYPE_DIRECTORY:
+					sfo = parseSFO(''.join(decryptRange(fp, header, fileD.fileOff, fileD.fileSize)))
+					for key, value in sfo.items():
+						if isinstance(value, str):
+							sfo[key] = value.decode('utf-8', 'replace')
+					entry["sfo"] = sfo
+					break
+	except Exception, e:
+		# a broken package must not stop the scan of the others
+		entry["error"] = str(e) or e.__class__.__name__
+	return entry
+
+def indexJob(args):
+	filename, key, mtime, size = args
+	entry = indexPkg(filename)
+	entry["mtime"] = mtime
+	entry["size"] = size
+	return key, entry
+
+def updateIndex(directory, indexFile, jobs=1):
+	"""Brings the index of all packages below `directory` up to date. Packages
+	whose mtime and size did not change are taken from the existing index,
+	the others are scanned on a pool."""
+	old = {}
+	if os.path.exists(indexFile):
+		with open(indexFile, 'rb') as fp:
+			old = json.load(fp)["packages"]
+	packages = {}
+	todo = []
+	for filename in findPkgs(directory):
+		mtime, size = pkgStat(filename)
+		key = os.path.relpath(filename, directory)
+		entry = old.get(key)
+		if entry != None and entry["mtime"] == mtime and entry["size"] == size:
+			packages[key] = entry
+		else:
+			todo.append((filename, key, mtime, size))
+	reused = len(packages)
+	if jobs > 1 and len(todo) > 1:
+		# parsing headers and PARAM.SFO is pure python, threads would share the GIL
+		pool = multiprocessing.Pool(min(jobs, len(todo)))
+		try:
+			results = pool.map(indexJob, todo)
+		finally:
+			pool.terminate()
+	else:
+		results = map(indexJob, todo)
+	for key, entry in results:
+		if "error" in entry:
+			print >> sys.stderr, "%s: %s" % (key, entry["error"])
+		packages[key] = entry
+	tmpFile = indexFile + ".tmp"
+	with open(tmpFile, 'wb') as fp:
+		json.dump({"version": 1, "packages": packages}, fp, indent=1, sort_keys=True)
+	os.rename(tmpFile, indexFile)
+	print >> sys.stderr, "%d packages: %d scanned, %d unchanged, %d removed" % (len(packages), len(todo), reused, len([key for key in old if key not in packages]))
+	return packages
+
+def queryIndex(packages, query):
+	"""Returns the entries whose contentID or TITLE_ID equal `query`."""
+	query = query.upper()
+	matches = []
+	for key in sorted(packages):
+		entry = packages[key]
+		if entry.get("contentID", "").upper() == query or entry.get("sfo", {}).get("TITLE_ID", "").upper() == query:
+			matches.append(dict(entry, file=key))
+	return matches
+
+def printIndex(entries, asJson=False):
+	if asJson:
+		print json.dumps(entries, indent=1, sort_keys=True)
+		return
+	for entry in entries:
+		sfo = entry.get("sfo", {})
+		out = u"%-36s %-9s %-5s %-5s %s  %s" % (entry.get("contentID", "?"), sfo.get("TITLE_ID", ""),
+			sfo.get("APP_VER", ""), sfo.get("CATEGORY", ""), sfo.get("TITLE", ""), entry["file"])
+		print out.encode('utf-8')
+
+def verifyEboot(fp, header, fileD):
+	"""Checks the EbootMeta of an NPDRM SELF. The SHA1 it carries covers the
+	bytes the metadata replaced, so only its internal consistency and the
+	contentID can be checked."""
+	inner = PkgFile(fp, header, fileD)
+	digestOff = findEbootMetaOff(inner)
+	if digestOff == None:
+		return "skipped"
+	meta = EbootMeta()
+	inner.seek(digestOff)
+	data = inner.read(len(meta))
+	if len(data) != len(meta):
+		return "bad"
+	meta.unpack(data)
+	if meta.magic != 0x4E504400 or meta.contentID != header.contentID:
+		return "bad"
+	for i in range(0, 0x10):
+		if meta.notSHA1[i] != (~meta.fileSHA1[i]) & 0xFF:
+			return "bad"
+		if meta.notXORKLSHA1[i] != ((i == 0xF) ^ meta.notSHA1[i] ^ 0xAA) & 0xFF:
+			return "bad"
+	return "ok"
+
+def verifyPkg(filename):
+	"""Checks the digests of a package. Returns a dict with "ok", "bad" or
+	"skipped" for every check. The QA digest covers the original file data,
+	which is unknown once an NPDRM SELF is packaged, so it is skipped then."""
+	result = {"file": filename, "checks": {}}
+	checks = result["checks"]
+	def check(name, good):
+		checks[name] = "ok" if good else "bad"
+	try:
+		with openPkg(filename) as fp:
+			header = readHeader(fp)
+			if header.magic != 0x7F504B47 or header.type != 0x00000001:
+				raise ValueError("not a supported package")
+			fp.seek(0)
+			head = fp.read(header.dataOff)
+			if len(head) != header.dataOff or header.dataOff < 0x140:
+				raise ValueError("truncated package")
+			fp.seek(0, 2)
+			check("size", fp.tell() == header.packageSize and header.dataOff + header.dataSize <= header.packageSize)
+
+			headerSHA = SHA1(head[0:0x80])[3:19]
+			check("header", head[0x80:0x90] == headerSHA)
+			metaData = head[header.pkgInfoOff:header.pkgInfoOff+0x40]
+			metaBlockSHA = SHA1(metaData)[3:19]
+			check("meta", head[header.pkgInfoOff+0x40:header.pkgInfoOff+0x50] == metaBlockSHA)
+			metaBlock = MetaHeader()
+			metaBlock.unpack(metaData)
+			check("metaDataSize", metaBlock.dataSize == header.dataSize)
+			metaBlockSHAPadEnc = crypt(keyToContext([ord(c) for c in metaBlockSHA]), '\0' * 0x30, 0x30)
+			check("metaPad", head[header.pkgInfoOff+0x50:header.pkgInfoOff+0x80] == metaBlockSHAPadEnc)
+			metaBlockSHAPadEnc2 = crypt(keyToContext([ord(c) for c in headerSHA]), metaBlockSHAPadEnc, 0x30)
+			check("headerPad", head[0x90:0xC0] == metaBlockSHAPadEnc2)
+			context = keyToContext(header.QADigest)
+			setContextNum(context, 0xFFFFFFFFFFFFFFFF)
+			check("klicensee", crypt(context, listToString(header.KLicensee), 0x10) == '\0' * 0x10)
+
+			fileDescs = readFileTable(fp, header)
+			descEnd = 0x20 * header.itemCount
+			for fileD in fileDescs:
+				descEnd = max(descEnd, fileD.fileNameOff + ((fileD.fileNameLength + 0x0F) & ~0x0F))
+			selfs = [fileD for fileD in fileDescs if fileD.flags & 0xFF == TYPE_NPDRMSELF]
+			for fileD in selfs:
+				checks["eboot:" + fileD.fileName] = verifyEboot(fp, header, fileD)
+			if selfs:
+				checks["qa"] = "skipped"
+			else:
+				qadigest = hashlib.sha1()
+				for fileD in fileDescs:
+					if fileD.flags & 0xFF != TYPE_DIRECTORY:
+						for chunk in decryptRange(fp, header, fileD.fileOff, fileD.fileSize):
+							qadigest.update(chunk)
+				qaHeader = Header()
+				qaHeader.unpack(head[0:len(qaHeader)])
+				for i in range(0, 0x30):
+					qaHeader.contentID[i] = 0
+				for i in range(0, 0x10):
+					qaHeader.QADigest[i] = 0
+					qaHeader.KLicensee[i] = 0
+				qadigest.update(qaHeader.pack())
+				qadigest.update(''.join(decryptRange(fp, header, 0, descEnd)))
+				check("qa", qadigest.digest()[0:0x10] == listToString(header.QADigest))
+	except (IOError, ValueError, AssertionError, struct.error), e:
+		result["error"] = str(e) or e.__class__.__name__
+	result["ok"] = "error" not in result and "bad" not in checks.values()
+	return result
+
+def verifyPkgs(filenames, jobs=1, asJson=False):
+	"""Verifies the packages on a pool, prints the results and returns
+	whether all of them are fine."""
+	if jobs > 1 and len(filenames) > 1:
+		pool = cryptPool(min(jobs, len(filenames)))
+		try:
+			results = pool.map(verifyPkg, filenames)
+		finally:
+			pool.terminate()
+	else:
+		results = map(verifyPkg, filenames)
+	if asJson:
+		print json.dumps(results, indent=1, sort_keys=True)
+	else:
+		for result in results:
+			if result["ok"]:
+				print "OK     %s" % result["file"]
+			else:
+				print "FAILED %s" % result["file"]
+			for name in sorted(result["checks"]):
+				print "    %-24s %s" % (name, result["checks"][name])
+			if "error" in result:
+				print "    error: %s" % result["error"]
+	return all(result["ok"] for result in results)
+
+def newFileHeader(name, size, isdir):
+	if isdir:
+		folder = FileHeader()
+		folder.fileName = name
+		folder.fileNameOff 	= 0
+		folder.fileNameLength = len(folder.fileName)
+		folder.fileOff 		= 0
+
+		folder.fileSize 	= 0
+		folder.flags		= TYPE_OVERWRITE_ALLOWED | TYPE_DIRECTORY
+		folder.padding 		= 0
+		return folder
+	file = FileHeader()
+	file.fileName = name
+	file.fileNameOff 	= 0
+	file.fileNameLength = len(file.fileName)
+	file.fileOff 		= 0
+	file.fileSize 	= size
+	file.flags		= TYPE_OVERWRITE_ALLOWED | TYPE_RAW
+	if name == "USRDIR/EBOOT.BIN":
+		file.fileSize = ((file.fileSize - 0x30 + 63) & ~63) + 0x30
+		file.flags		= TYPE_OVERWRITE_ALLOWED | TYPE_NPDRMSELF
+
+	file.padding 		= 0
+	return file
+
 def getFiles(files, folder, original):
 	oldfolder = folder
 	foundFiles = glob.glob( os.path.join(folder, '*') )
@@ -350,33 +1071,398 @@ def getFiles(files, folder, original):
 		newpath = filepath.replace("\\", "/")
 		newpath = newpath[len(original):]
 		if os.path.isdir(filepath):
-			folder = FileHeader()
-			folder.fileName = newpath
-			folder.fileNameOff 	= 0
-			folder.fileNameLength = len(folder.fileName)
-			folder.fileOff 		= 0
-
-			folder.fileSize 	= 0
-			folder.flags		= TYPE_OVERWRITE_ALLOWED | TYPE_DIRECTORY
-			folder.padding 		= 0
-			files.append(folder)
+			files.append(newFileHeader(newpath, 0, True))
 			getFiles(files, filepath, original)
 		else:
-			file = FileHeader()
-			file.fileName = newpath
-			file.fileNameOff 	= 0
-			file.fileNameLength = len(file.fileName)
-			file.fileOff 		= 0
-			file.fileSize 	= os.path.getsize(filepath)
-			file.flags		= TYPE_OVERWRITE_ALLOWED | TYPE_RAW
-			if newpath == "USRDIR/EBOOT.BIN":
-				file.fileSize = ((file.fileSize - 0x30 + 63) & ~63) + 0x30
-				file.flags		= TYPE_OVERWRITE_ALLOWED | TYPE_NPDRMSELF
-
-			file.padding 		= 0
-			files.append(file)
-
-def pack(folder, contentid, contenttype, outname=None):
+			files.append(newFileHeader(newpath, os.path.getsize(filepath), False))
+
+class DirSource(object):
+	"""Pack input from a directory, its files are opened by path."""
+	def __init__(self, folder):
+		# getFiles cuts the folder off the paths it finds, it needs the separator
+		self.folder = os.path.join(folder, "")
+	def getFiles(self):
+		files = []
+		getFiles(files, self.folder, self.folder)
+		return files
+	def path(self, name):
+		return os.path.join(self.folder, name)
+	def open(self, name):
+		return open(self.path(name), 'rb')
+	def size(self, name):
+		return os.path.getsize(self.path(name))
+	def close(self):
+		pass
+
+class ArchiveMember(object):
+	"""Sequential reader of an archive member. Seeking forward skips data,
+	seeking backwards opens the member again."""
+	def __init__(self, source, name):
+		self.source = source
+		self.name = name
+		self.fp = source.openMember(name)
+		self.pos = 0
+	def read(self, size=-1):
+		if size < 0:
+			data = self.fp.read()
+		else:
+			data = self.fp.read(size)
+		self.pos += len(data)
+		return data
+	def seek(self, offset, whence=0):
+		assert whence == 0, "Archive members only support absolute seeks"
+		if offset < self.pos:
+			self.fp.close()
+			self.fp = self.source.openMember(self.name)
+			self.pos = 0
+		while self.pos < offset:
+			if len(self.read(min(PARALLEL_CHUNK, offset - self.pos))) == 0:
+				break
+	def tell(self):
+		return self.pos
+	def close(self):
+		self.fp.close()
+	def __enter__(self):
+		return self
+	def __exit__(self, *args):
+		self.close()
+
+def memberName(name):
+	return "/".join(part for part in name.split("/") if part not in ("", "."))
+
+def linkTarget(info, byName):
+	"""Follows hard and symbolic links of a tar member to the regular file
+	they point to, anything else cannot be packed."""
+	start = info
+	for i in range(0, 32):
+		if info.isfile():
+			return info
+		if info.islnk():
+			name = memberName(info.linkname)
+		elif info.issym() and not info.linkname.startswith("/"):
+			name = posixpath.normpath(posixpath.join(posixpath.dirname(memberName(info.name)), info.linkname))
+		else:
+			break
+		if name not in byName:
+			break
+		info = byName[name]
+	raise IOError("Unsupported archive member %s: link to %s is not a file in the archive" % (start.name, start.linkname))
+
+# top level directories of the package contents, never stripped from archives
+PACKAGE_DIRS = ("USRDIR", "TROPDIR", "LICDIR", "PS3_EXTRA")
+
+class ArchiveSource(object):
+	"""Pack input from a tar (optionally compressed) or zip archive. Members
+	are streamed out of the archive, nothing is extracted. If all members
+	share one top level directory that is not one of PACKAGE_DIRS, it is
+	stripped."""
+	def __init__(self, filename):
+		self.tmp = None
+		if zipfile.is_zipfile(filename):
+			self.archive = zipfile.ZipFile(filename)
+			members = [(info.filename, info.file_size, info.filename.endswith("/"), info)
+				for info in self.archive.infolist()]
+		else:
+			self.archive = self.openTar(filename)
+			infos = self.archive.getmembers()
+			byName = dict((memberName(info.name), info) for info in infos)
+			members = []
+			for info in infos:
+				if info.isfile() or info.isdir():
+					members.append((info.name, info.size, info.isdir(), info))
+				elif info.islnk() or info.issym():
+					# packed like the file a directory source would read through the link
+					target = linkTarget(info, byName)
+					members.append((info.name, target.size, False, target))
+		self.members = {}
+		self.dirs = set([""])
+		self.children = collections.defaultdict(set)
+		names = []
+		for name, size, isdir, info in members:
+			name = memberName(name)
+			if name:
+				names.append((name, size, isdir, info))
+		tops = set(name.split("/")[0] for name, size, isdir, info in names)
+		strip = len(tops) == 1 and list(tops)[0].upper() not in PACKAGE_DIRS and \
+			all("/" in name or isdir for name, size, isdir, info in names)
+		for name, size, isdir, info in names:
+			if strip:
+				name = name.partition("/")[2]
+				if not name:
+					continue
+			parts = name.split("/")
+			for i in range(1, len(parts)):
+				self.dirs.add("/".join(parts[0:i]))
+				self.children["/".join(parts[0:i-1])].add("/".join(parts[0:i]))
+			self.children["/".join(parts[0:-1])].add(name)
+			if isdir:
+				self.dirs.add(name)
+			else:
+				self.members[name] = (size, info)
+	def openTar(self, filename):
+		"""Members are read in package order, not archive order. Every
+		backwards seek in a compressed tar decompresses it again from the
+		start, so such a tar is decompressed once into a temporary file."""
+		try:
+			return tarfile.open(filename, "r:")
+		except tarfile.ReadError:
+			pass
+		with open(filename, 'rb') as fp:
+			magic = fp.read(3)
+		if magic[0:2] == "\x1f\x8b":
+			src = gzip.open(filename, 'rb')
+		elif magic == "BZh":
+			src = bz2.BZ2File(filename, 'rb')
+		else:
+			return tarfile.open(filename, "r:*")
+		self.tmp = tempfile.TemporaryFile()
+		try:
+			shutil.copyfileobj(src, self.tmp, PARALLEL_CHUNK)
+		finally:
+			src.close()
+		self.tmp.seek(0)
+		return tarfile.open(fileobj=self.tmp, mode="r:")
+	def getFiles(self, folder=""):
+		"""Lists the members like getFiles lists a directory: the files of
+		every directory first, then its subdirectories."""
+		files = []
+		children = sorted(self.children[folder])
+		for name in children:
+			if name not in self.dirs:
+				files.append(newFileHeader(name, self.size(name), False))
+		for name in children:
+			if name in self.dirs:
+				files.append(newFileHeader(name, 0, True))
+				files.extend(self.getFiles(name))
+		return files
+	def path(self, name):
+		return None
+	def openMember(self, name):
+		if isinstance(self.archive, zipfile.ZipFile):
+			return self.archive.open(self.members[name][1])
+		return self.archive.extractfile(self.members[name][1])
+	def open(self, name):
+		return ArchiveMember(self, name)
+	def size(self, name):
+		return self.members[name][0]
+	def close(self):
+		self.archive.close()
+		if self.tmp != None:
+			self.tmp.close()
+
+def openSource(folder):
+	if os.path.isdir(folder):
+		return DirSource(folder)
+	return ArchiveSource(folder)
+
+def hashFile(fp, *digests):
+	while True:
+		if profiler:
+			start = time.time()
+		data = fp.read(PARALLEL_CHUNK)
+		if profiler:
+			profiler.add("read", start, len(data))
+			start = time.time()
+		if len(data) == 0:
+			break
+		for digest in digests:
+			digest.update(data)
+		if profiler:
+			profiler.add("hash", start, len(data))
+
+def findEbootMetaOff(fp):
+	"""Returns the offset behind the type 3 digest block of an NPDRM SELF,
+	where the EbootMeta is placed, or None for any other file."""
+	fp.seek(0)
+	if fp.read(9) != "SCE\0\0\0\0\x02\x80":
+		return None
+	fselfheader = SelfHeader()
+	fp.seek(0)
+	fselfheader.unpack(fp.read(len(fselfheader)))
+	appheader = AppInfo()
+	fp.seek(fselfheader.AppInfo)
+	appheader.unpack(fp.read(len(appheader)))
+	found = False
+	digestOff = fselfheader.digest
+	while not found:
+		digest = DigestBlock()
+		fp.seek(digestOff)
+		digest.unpack(fp.read(len(digest)))
+		if digest.type == 3:
+			found = True
+		else:
+			digestOff += digest.size
+		if digest.isNext != 1:
+			break
+	digestOff += len(digest)
+	if appheader.appType == 8 and found:
+		return digestOff
+	return None
+
+def ebootMeta(drmType, contentid, fileSHA1):
+	meta = EbootMeta()
+	meta.magic = 0x4E504400
+	meta.unk1 			= 1
+	meta.drmType 		= drmType
+	meta.unk2			= 1
+	for i in range(0,min(len(contentid), 0x30)):
+		meta.contentID[i] = ord(contentid[i])
+	for i in range(0,0x10):
+		meta.fileSHA1[i] 		= ord(fileSHA1[i])
+		meta.notSHA1[i] 		= (~meta.fileSHA1[i]) & 0xFF
+		if i == 0xF:
+			meta.notXORKLSHA1[i] 	= (1 ^ meta.notSHA1[i] ^ 0xAA) & 0xFF
+		else:
+			meta.notXORKLSHA1[i] 	= (0 ^ meta.notSHA1[i] ^ 0xAA) & 0xFF
+		meta.nulls[i] 			= 0
+	return meta.pack()
+
+def fileSHA1(path):
+	digest = hashlib.sha1()
+	with open(path, 'rb') as fp:
+		hashFile(fp, digest)
+	return digest.digest()
+
+def packSegments(source, files, fileDesc, metas):
+	"""Describes the plain data section of a package as a sorted list of
+	(offset, size, source), where source is either a string or a (name, offset)
+	tuple into a file. Anything not covered by a segment is zero padding."""
+	segments = [(0, len(fileDesc), fileDesc)]
+	for file in files:
+		if file.flags & 0xFF == TYPE_DIRECTORY:
+			continue
+		name = file.fileName
+		size = source.size(name)
+		pos = file.fileOff
+		if name in metas:
+			digestOff, meta = metas[name]
+			head = min(digestOff, size)
+			segments.append((pos, head, (name, 0)))
+			segments.append((pos + head, len(meta), meta))
+			pos += head + len(meta)
+			segments.append((pos, max(0, size - digestOff - len(meta)), (name, digestOff + len(meta))))
+		else:
+			segments.append((pos, size, (name, 0)))
+	return segments
+
+def packTasks(outname, splitSize, prefix, dataOff, dataSize, source, segments):
+	"""Splits the data section into PARALLEL_CHUNK sized ranges, each with the
+	parts of the segments it covers. Files the workers cannot open by path are
+	read here, sequentially."""
+	first = 0
+	reader = None
+	try:
+		for start in xrange(0, dataSize, PARALLEL_CHUNK):
+			end = min(start + PARALLEL_CHUNK, dataSize)
+			while first < len(segments) and segments[first][0] + segments[first][1] <= start:
+				first += 1
+			parts = []
+			for pos, size, src in segments[first:]:
+				if pos >= end:
+					break
+				lo = max(pos, start)
+				hi = min(pos + size, end)
+				if hi <= lo:
+					continue
+				if isinstance(src, str):
+					parts.append((lo - start, hi - lo, src[lo - pos:hi - pos], 0))
+					continue
+				name, srcOff = src
+				path = source.path(name)
+				if path != None:
+					parts.append((lo - start, hi - lo, (path, srcOff), lo - pos))
+					continue
+				if reader == None or reader.name != name:
+					if reader != None:
+						reader.close()
+					reader = source.open(name)
+				reader.seek(srcOff + lo - pos)
+				parts.append((lo - start, hi - lo, reader.read(hi - lo), 0))
+			yield (outname, splitSize, prefix, dataOff, start, end - start, parts)
+	finally:
+		if reader != None:
+			reader.close()
+
+def packChunk(args):
+	"""Gathers, encrypts and writes one range of the data section to its own
+	offset of the output file."""
+	outname, splitSize, prefix, dataOff, start, size, parts = args
+	if profiler:
+		begin = time.time()
+	buf = bytearray(size)
+	for off, length, src, skip in parts:
+		if isinstance(src, str):
+			buf[off:off+length] = src
+		else:
+			path, srcOff = src
+			with open(path, 'rb') as fp:
+				fp.seek(srcOff + skip)
+				data = fp.read(length)
+			buf[off:off+len(data)] = data
+	if profiler:
+		profiler.add("read", begin, size)
+	data = cryptAt(prefix, start / 0x10, str(buf), size)
+	if profiler:
+		begin = time.time()
+	with openOutput(outname, splitSize) as fp:
+		fp.seek(dataOff + start)
+		fp.write(data)
+	if profiler:
+		profiler.add("write", begin, size)
+	return size
+
+def digestFiles(source, files, qadigest, jobs=1):
+	"""Feeds every file to the QA digest and returns the SHA1 of the NPDRM
+	EBOOTs with the offset of their metadata. With more than one job the SHA1
+	of files on disk is computed on a pool while the QA digest is being
+	updated."""
+	pool = None
+	if jobs > 1:
+		pool = cryptPool(jobs)
+	try:
+		selfs = {}
+		for file in files:
+			if file.flags & 0xFF == TYPE_DIRECTORY:
+				continue
+			path = source.path(file.fileName)
+			with source.open(file.fileName) as fp:
+				digestOff = findEbootMetaOff(fp)
+				fp.seek(0)
+				if digestOff == None:
+					hashFile(fp, qadigest)
+				elif pool != None and path != None:
+					selfs[file.fileName] = (digestOff, pool.apply_async(fileSHA1, (path,)))
+					hashFile(fp, qadigest)
+				else:
+					digest = hashlib.sha1()
+					hashFile(fp, qadigest, digest)
+					selfs[file.fileName] = (digestOff, digest.digest())
+		for fileName, (digestOff, digest) in selfs.items():
+			if not isinstance(digest, str):
+				selfs[fileName] = (digestOff, digest.get())
+		return selfs
+	finally:
+		if pool != None:
+			pool.terminate()
+
+def encryptData(outname, header, source, segments, jobs=1, splitSize=None):
+	"""Encrypts the data section described by `segments` into the already
+	created output file. The keystream only depends on the offset, so disjoint
+	ranges are encrypted and written by the workers on their own."""
+	prefix = listToString(keyToContext(header.QADigest)[0:0x38])
+	tasks = packTasks(outname, splitSize, prefix, header.dataOff, header.dataSize, source, segments)
+	if jobs <= 1:
+		for task in tasks:
+			packChunk(task)
+		return
+	pool = cryptPool(jobs)
+	try:
+		for size in orderedMap(pool, packChunk, tasks, jobs * 2):
+			pass
+	finally:
+		pool.terminate()
+
+def pack(folder, contentid, contenttype, outname=None, jobs=1, quiet=False, splitSize=None):
 
 	qadigest = hashlib.sha1()
 
@@ -450,11 +1536,13 @@ def pack(folder, contentid, contenttype, outname=None):
 	metaBlock.packageVersion 	= 0
 
 
-	files = []
-	getFiles(files, folder, folder)
+	source = openSource(folder)
+	if profiler:
+		start = time.time()
+	files = source.getFiles()
+	if profiler:
+		profiler.add("walk", start)
 	header.itemCount = len(files)
-	dataToEncrypt = ""
-	fileDescLength = 0
 	fileOff = 0x20 * len(files)
 	for file in files:
 		alignedSize = (file.fileNameLength + 0x0F) & ~0x0F
@@ -463,74 +1551,54 @@ def pack(folder, contentid, contenttype, outname=None):
 	for file in files:
 		file.fileOff = fileOff
 		fileOff += (file.fileSize + 0x0F) & ~0x0F
-		dataToEncrypt += file.pack()
+	fileDesc = ""
 	for file in files:
-		alignedSize = (file.fileNameLength + 0x0F) & ~0x0F
-		dataToEncrypt += file.fileName
-		dataToEncrypt += "\0" * (alignedSize-file.fileNameLength)
-	fileDescLength = len(dataToEncrypt)
+		fileDesc += file.pack()
 	for file in files:
-		if not file.flags & 0xFF == TYPE_DIRECTORY:
-			path = os.path.join(folder, file.fileName)
-			fp = open(path, 'rb')
-			fileData = fp.read()
-			qadigest.update(fileData)
-			fileSHA1 = SHA1(fileData)
-			fp.close()
-			if fileData[0:9] == "SCE\0\0\0\0\x02\x80":
-				fselfheader = SelfHeader()
-				fselfheader.unpack(fileData[0:len(fselfheader)])
-				appheader = AppInfo()
-				appheader.unpack(fileData[fselfheader.AppInfo:fselfheader.AppInfo+len(appheader)])
-				found = False
-				digestOff = fselfheader.digest
-				while not found:
-					digest = DigestBlock()
-					digest.unpack(fileData[digestOff:digestOff+len(digest)])
-					if digest.type == 3:
-						found = True
-					else:
-						digestOff += digest.size
-					if digest.isNext != 1:
-						break
-				digestOff += len(digest)
-				if appheader.appType == 8 and found:
-					dataToEncrypt += fileData[0:digestOff]
-
-					meta = EbootMeta()
-					meta.magic = 0x4E504400
-					meta.unk1 			= 1
-					meta.drmType 		= metaBlock.drmType
-					meta.unk2			= 1
-					for i in range(0,min(len(contentid), 0x30)):
-						meta.contentID[i] = ord(contentid[i])
-					for i in range(0,0x10):
-						meta.fileSHA1[i] 		= ord(fileSHA1[i])
-						meta.notSHA1[i] 		= (~meta.fileSHA1[i]) & 0xFF
-						if i == 0xF:
-							meta.notXORKLSHA1[i] 	= (1 ^ meta.notSHA1[i] ^ 0xAA) & 0xFF
-						else:
-							meta.notXORKLSHA1[i] 	= (0 ^ meta.notSHA1[i] ^ 0xAA) & 0xFF
-						meta.nulls[i] 			= 0
-					dataToEncrypt += meta.pack()
-					dataToEncrypt += fileData[digestOff + 0x80:]
-				else:
-					dataToEncrypt += fileData
-			else:
-				dataToEncrypt += fileData
+		alignedSize = (file.fileNameLength + 0x0F) & ~0x0F
+		fileDesc += file.fileName
+		fileDesc += "\0" * (alignedSize-file.fileNameLength)
 
-			dataToEncrypt += '\0' * (((file.fileSize + 0x0F) & ~0x0F) - len(fileData))
-	header.dataSize = len(dataToEncrypt)
+	if outname == None:
+		outname = contentid + ".pkg"
+	# first pass: QA digest and the metadata spliced into NPDRM EBOOTs
+	metas = {}
+	for fileName, (digestOff, digest) in digestFiles(source, files, qadigest, jobs).items():
+		metas[fileName] = (digestOff, ebootMeta(metaBlock.drmType, contentid, digest))
+
+	header.dataSize = fileOff
 	metaBlock.dataSize 	= header.dataSize
 	header.packageSize = header.dataSize + 0x1A0
 	head = header.pack()
 	qadigest.update(head)
-	qadigest.update(dataToEncrypt[0:fileDescLength])
+	qadigest.update(fileDesc)
 	QA_Digest = qadigest.digest()
 
 	for i in range(0, 0x10):
 		header.QADigest[i] = ord(QA_Digest[i])
 
+	setContentID(header, contentid)
+
+	outFile = createPkg(outname, header.packageSize, splitSize)
+	writeHead(outFile, header, metaBlock)
+
+	outFile.seek(header.dataOff + header.dataSize)
+	outFile.write('\0' * 0x60)
+	outFile.close()
+
+	# second pass: encrypt the data section into the output
+	encryptData(outname, header, source, packSegments(source, files, fileDesc, metas), jobs, splitSize)
+	source.close()
+	if not quiet:
+		print header
+	return header
+
+def setContentID(header, contentid):
+	"""Sets the contentID and the KLicensee derived from the QA digest."""
+	for i in range(0, 0x30):
+		header.contentID[i] = 0
+	for i in range(0, 0x10):
+		header.KLicensee[i] = 0
 	for i in range(0, min(len(contentid), 0x30)):
 		header.contentID[i] = ord(contentid[i])
 
@@ -541,10 +1609,9 @@ def pack(folder, contentid, contenttype, outname=None):
 	for i in range(0, min(len(contentid), 0x10)):
 		header.KLicensee[i] = ord(licensee[i])
 
-	if outname != None:
-		outFile = open(outname, 'wb')
-	else:
-		outFile = open(contentid + ".pkg", 'wb')
+def writeHead(outFile, header, metaBlock):
+	"""Writes the header, the metadata block and their digests."""
+	outFile.seek(0)
 	outFile.write(header.pack())
 	headerSHA = SHA1(header.pack())[3:19]
 	outFile.write(headerSHA)
@@ -564,23 +1631,403 @@ def pack(folder, contentid, contenttype, outname=None):
 	outFile.write(metaBlockSHA)
 	outFile.write(metaBlockSHAPadEnc)
 
-	context = keyToContext(header.QADigest)
-	encData = crypt(context, dataToEncrypt, header.dataSize)
-	outFile.write(encData)
-	outFile.write('\0' * 0x60)
-	outFile.close()
-	print header
+def writeRange(fp, header, offset, data):
+	"""Encrypts `data` into the data section at `offset`. Partially covered
+	blocks at either end are decrypted and merged first."""
+	skip = offset % 0x10
+	start = offset - skip
+	end = (offset + len(data) + 0x0F) & ~0x0F
+	plain = ''.join(decryptRange(fp, header, start, end - start))
+	plain = plain[0:skip] + data + plain[skip + len(data):]
+	prefix = listToString(keyToContext(header.QADigest)[0:0x38])
+	fp.seek(header.dataOff + start)
+	fp.write(cryptAt(prefix, start / 0x10, plain, len(plain)))
+
+def patchMeta(filename, contentid=None, drmType=None):
+	"""Changes the contentID and/or drmType of a package in place. Only the
+	header, the metadata block, their digests and the EbootMeta of every NPDRM
+	SELF are rewritten, the data key (the QA digest) does not depend on them."""
+	with openPkg(filename, 'r+b') as fp:
+		header = readHeader(fp)
+		assert header.type == 0x00000001, 'Unsupported Type'
+		metaBlock = readMetaHeader(fp, header)
+		if contentid != None:
+			setContentID(header, contentid)
+		if drmType != None:
+			metaBlock.drmType = drmType
+		patched = 0
+		for fileD in readFileTable(fp, header):
+			if fileD.flags & 0xFF != TYPE_NPDRMSELF:
+				continue
+			inner = PkgFile(fp, header, fileD)
+			digestOff = findEbootMetaOff(inner)
+			if digestOff == None:
+				continue
+			meta = EbootMeta()
+			inner.seek(digestOff)
+			meta.unpack(inner.read(len(meta)))
+			if meta.magic != 0x4E504400:
+				continue
+			meta.contentID = list(header.contentID)
+			meta.drmType = metaBlock.drmType
+			writeRange(fp, header, fileD.fileOff + digestOff, meta.pack())
+			patched += 1
+		writeHead(fp, header, metaBlock)
+	print "%s: contentID %s, drmType %d, %d EBOOT metadata blocks patched" % (filename, nullterm(header.contentID), metaBlock.drmType, patched)
+
+# Deltas compare the plain data of files in blocks of DELTA_BLOCK bytes.
+DELTA_MAGIC = "PKGDELTA"
+DELTA_VERSION = 1
+DELTA_BLOCK = 0x10000
+packDeltaLiteral = struct.Struct('>cQI')
+packDeltaCopy = struct.Struct('>cQQQ')
+
+class DeltaWriter(object):
+	"""Writes the records of a delta through zlib. Adjacent copies are
+	merged."""
+	def __init__(self, fp):
+		self.fp = fp
+		self.compressor = zlib.compressobj(9)
+		self.copy = None
+		self.copied = 0
+		self.literal = 0
+	def write(self, data):
+		self.fp.write(self.compressor.compress(data))
+	def flushCopy(self):
+		if self.copy != None:
+			self.write(packDeltaCopy.pack('C', *self.copy))
+			self.copy = None
+	def addCopy(self, pos, oldPos, size):
+		self.copied += size
+		if self.copy != None and self.copy[0] + self.copy[2] == pos and self.copy[1] + self.copy[2] == oldPos:
+			self.copy = (self.copy[0], self.copy[1], self.copy[2] + size)
+			return
+		self.flushCopy()
+		self.copy = (pos, oldPos, size)
+	def addLiteral(self, pos, data):
+		self.flushCopy()
+		self.literal += len(data)
+		self.write(packDeltaLiteral.pack('L', pos, len(data)))
+		self.write(data)
+	def close(self):
+		self.flushCopy()
+		self.write('E')
+		self.fp.write(self.compressor.flush())
+
+class DeltaReader(object):
+	"""Reads exact amounts of data from a zlib compressed delta. At most
+	PARALLEL_CHUNK bytes are decompressed at a time, the buffer is only
+	compacted when it is refilled."""
+	def __init__(self, fp):
+		self.fp = fp
+		self.decompressor = zlib.decompressobj()
+		self.buf = ""
+		self.pos = 0
+		self.flushed = False
+	def read(self, size):
+		while len(self.buf) - self.pos < size:
+			if self.flushed:
+				raise IOError("Truncated delta")
+			data = self.decompressor.unconsumed_tail
+			if len(data) == 0:
+				data = self.fp.read(PARALLEL_CHUNK)
+			if len(data) == 0:
+				more = self.decompressor.flush()
+				self.flushed = True
+			else:
+				more = self.decompressor.decompress(data, PARALLEL_CHUNK)
+			self.buf = self.buf[self.pos:] + more
+			self.pos = 0
+		data = self.buf[self.pos:self.pos+size]
+		self.pos += size
+		return data
+
+def dataRange(fileD):
+	"""Returns offset and size of a file in the data section, padding included."""
+	return fileD.fileOff, (fileD.fileSize + 0x0F) & ~0x0F
+
+def descSize(header, fileDescs):
+	size = 0x20 * header.itemCount
+	for fileD in fileDescs:
+		size = max(size, fileD.fileNameOff + ((fileD.fileNameLength + 0x0F) & ~0x0F))
+	return size
+
+def rangeSHA1(fp, header, offset, size):
+	digest = hashlib.sha1()
+	for chunk in decryptRange(fp, header, offset, size):
+		digest.update(chunk)
+	return digest.digest()
+
+def diffPkg(oldname, newname, deltaname):
+	"""Writes a delta that turns the package `oldname` into `newname`. Files
+	are compared by name block by block, files without a namesake are
+	looked up by size and SHA1. Old files no new file could match are never
+	read."""
+	with openPkg(oldname) as oldFp:
+		with openPkg(newname) as newFp:
+			oldHeader = readHeader(oldFp)
+			newHeader = readHeader(newFp)
+			assert oldHeader.type == 0x00000001 and newHeader.type == 0x00000001, 'Unsupported Type'
+			oldFiles = [fileD for fileD in readFileTable(oldFp, oldHeader) if fileD.flags & 0xFF != TYPE_DIRECTORY]
+			newDescs = readFileTable(newFp, newHeader)
+			oldByName = dict((fileD.fileName, fileD) for fileD in oldFiles)
+			oldBySize = collections.defaultdict(list)
+			for fileD in oldFiles:
+				oldBySize[dataRange(fileD)[1]].append(fileD)
+			oldSHA1 = {}
+
+			newFp.seek(0)
+			head = newFp.read(newHeader.dataOff)
+			newFp.seek(newHeader.dataOff + newHeader.dataSize)
+			trailer = newFp.read(newHeader.packageSize - newHeader.dataOff - newHeader.dataSize)
+			oldFp.seek(0x80)
+			oldId = listToString(oldHeader.QADigest) + oldFp.read(0x10)
+
+			with open(deltaname, 'wb') as fp:
+				delta = DeltaWriter(fp)
+				delta.write(DELTA_MAGIC + struct.pack('>I', DELTA_VERSION) + oldId)
+				delta.write(struct.pack('>QI', newHeader.packageSize, len(head)) + head)
+				delta.write(struct.pack('>I', len(trailer)) + trailer)
+				delta.addLiteral(0, ''.join(decryptRange(newFp, newHeader, 0, descSize(newHeader, newDescs))))
+				# the records must be in data section order, the file table need not be
+				for fileD in sorted(newDescs, key=lambda fileD: fileD.fileOff):
+					if fileD.flags & 0xFF == TYPE_DIRECTORY:
+						continue
+					pos, size = dataRange(fileD)
+					old = oldByName.get(fileD.fileName)
+					if old != None:
+						oldPos, oldSize = dataRange(old)
+						for offset in xrange(0, size, DELTA_BLOCK):
+							length = min(DELTA_BLOCK, size - offset)
+							data = ''.join(decryptRange(newFp, newHeader, pos + offset, length))
+							if offset + length <= oldSize and ''.join(decryptRange(oldFp, oldHeader, oldPos + offset, length)) == data:
+								delta.addCopy(pos + offset, oldPos + offset, length)
+							else:
+								delta.addLiteral(pos + offset, data)
+						continue
+					match = None
+					if oldBySize[size]:
+						digest = rangeSHA1(newFp, newHeader, pos, size)
+						for candidate in oldBySize[size]:
+							if candidate.fileName not in oldSHA1:
+								oldSHA1[candidate.fileName] = rangeSHA1(oldFp, oldHeader, *dataRange(candidate))
+							if oldSHA1[candidate.fileName] == digest:
+								match = candidate
+								break
+					if match != None:
+						delta.addCopy(pos, match.fileOff, size)
+					else:
+						for offset in xrange(0, size, PARALLEL_CHUNK):
+							delta.addLiteral(pos + offset, ''.join(decryptRange(newFp, newHeader, pos + offset, min(PARALLEL_CHUNK, size - offset))))
+				delta.close()
+				print "%s: %d bytes copied, %d bytes literal, %d bytes delta" % (deltaname, delta.copied, delta.literal, fp.tell())
+
+def deltaPieces(delta, oldFp, oldHeader, dataSize):
+	"""Yields the plain data section described by the records of a delta,
+	zero filling the gaps between them."""
+	pos = 0
+	while True:
+		kind = delta.read(1)
+		if kind == 'E':
+			break
+		elif kind == 'L':
+			kind, start, size = packDeltaLiteral.unpack(kind + delta.read(packDeltaLiteral.size - 1))
+			source = None
+		elif kind == 'C':
+			kind, start, oldPos, size = packDeltaCopy.unpack(kind + delta.read(packDeltaCopy.size - 1))
+			source = decryptRange(oldFp, oldHeader, oldPos, size)
+		else:
+			raise IOError("Invalid delta record %r" % kind)
+		if start < pos or start + size > dataSize:
+			raise IOError("Invalid delta range %x-%x" % (start, start + size))
+		if start > pos:
+			yield '\0' * (start - pos)
+		if source == None:
+			yield delta.read(size)
+		else:
+			for chunk in source:
+				yield chunk
+		pos = start + size
+	if pos < dataSize:
+		yield '\0' * (dataSize - pos)
+
+def rechunk(pieces, size):
+	"""Joins a stream of strings into chunks of `size` bytes."""
+	buf = []
+	buffered = 0
+	for piece in pieces:
+		buf.append(piece)
+		buffered += len(piece)
+		if buffered >= size:
+			data = ''.join(buf)
+			for offset in xrange(0, len(data) - size + 1, size):
+				yield data[offset:offset+size]
+			rest = data[len(data) - len(data) % size:]
+			buf = [rest]
+			buffered = len(rest)
+	if buffered:
+		yield ''.join(buf)
+
+def applyDelta(oldname, deltaname, outname, jobs=1, splitSize=None):
+	"""Rebuilds the new package from the old one and a delta written by
+	diffPkg, streaming and encrypting the data section with the new key."""
+	with openPkg(oldname) as oldFp:
+		with open(deltaname, 'rb') as fp:
+			delta = DeltaReader(fp)
+			if delta.read(len(DELTA_MAGIC)) != DELTA_MAGIC or struct.unpack('>I', delta.read(4))[0] != DELTA_VERSION:
+				raise IOError("%s is not a package delta" % deltaname)
+			oldHeader = readHeader(oldFp)
+			oldFp.seek(0x80)
+			if delta.read(0x20) != listToString(oldHeader.QADigest) + oldFp.read(0x10):
+				raise IOError("%s does not apply to %s" % (deltaname, oldname))
+			packageSize, headSize = struct.unpack('>QI', delta.read(12))
+			head = delta.read(headSize)
+			trailer = delta.read(struct.unpack('>I', delta.read(4))[0])
+			header = Header()
+			header.unpack(head[0:len(header)])
+
+			outFile = createPkg(outname, packageSize, splitSize)
+			pool = None
+			if jobs > 1:
+				pool = cryptPool(jobs)
+			try:
+				outFile.write(head)
+				prefix = listToString(keyToContext(header.QADigest)[0:0x38])
+				pieces = deltaPieces(delta, oldFp, oldHeader, header.dataSize)
+				chunks = ((prefix, index * (PARALLEL_CHUNK / 0x10), chunk)
+					for index, chunk in enumerate(rechunk(pieces, PARALLEL_CHUNK)))
+				if pool != None:
+					encrypted = orderedMap(pool, cryptChunk, chunks, jobs * 2)
+				else:
+					encrypted = (cryptChunk(chunk) for chunk in chunks)
+				for chunk in encrypted:
+					outFile.write(chunk)
+				outFile.write(trailer)
+			finally:
+				outFile.close()
+				if pool != None:
+					pool.terminate()
+
+def readManifest(filename):
+	"""Reads a batch manifest. Every section names an output package relative
+	to the manifest, with the options folder, contentid, contenttype and
+	splitsize."""
+	config = ConfigParser.RawConfigParser({"contenttype": "gamedata", "splitsize": ""})
+	with open(filename, 'rb') as fp:
+		config.readfp(fp)
+	base = os.path.dirname(filename)
+	jobs = []
+	for section in config.sections():
+		splitSize = None
+		if config.get(section, "splitsize"):
+			splitSize = int(config.get(section, "splitsize"), 0)
+		jobs.append((os.path.join(base, config.get(section, "folder")),
+			config.get(section, "contentid"), config.get(section, "contenttype"),
+			os.path.join(base, section), splitSize))
+	return jobs
+
+def packJob(args):
+	folder, contentid, contenttype, outname, splitSize = args
+	result = {"file": outname, "folder": folder, "contentID": contentid}
+	start = time.time()
+	try:
+		header = pack(folder, contentid, contenttype, outname, quiet=True, splitSize=splitSize)
+		result["bytes"] = header.packageSize
+	except Exception, e:
+		# one failed package must not abort the rest of the batch
+		result["error"] = "%s: %s" % (e.__class__.__name__, e)
+	result["seconds"] = time.time() - start
+	if "bytes" in result and result["seconds"] > 0:
+		result["MBps"] = result["bytes"] / result["seconds"] / 1e6
+	return result
+
+def packBatch(manifest, jobs=1, asJson=False):
+	"""Builds all packages of a manifest, one per worker process, and returns
+	whether all of them were built."""
+	tasks = readManifest(manifest)
+	start = time.time()
+	if jobs > 1 and len(tasks) > 1:
+		pool = multiprocessing.Pool(min(jobs, len(tasks)))
+		try:
+			results = pool.imap_unordered(packJob, tasks)
+			results = [printPackResult(result, asJson) for result in results]
+		finally:
+			pool.terminate()
+	else:
+		results = [printPackResult(packJob(task), asJson) for task in tasks]
+	seconds = time.time() - start
+	total = sum(result.get("bytes", 0) for result in results)
+	failed = len([result for result in results if "error" in result])
+	if asJson:
+		print json.dumps({"packages": results, "seconds": seconds, "bytes": total, "failed": failed}, indent=1, sort_keys=True)
+	else:
+		print "%d packages, %d failed, %d bytes in %.2fs" % (len(results), failed, total, seconds)
+	return failed == 0
+
+def printPackResult(result, asJson=False):
+	if asJson:
+		return result
+	if "error" in result:
+		print "FAILED %s: %s" % (result["file"], result["error"])
+	else:
+		print "OK     %s %12d bytes %8.2fs %8.2f MB/s" % (result["file"], result["bytes"], result["seconds"], result.get("MBps", 0))
+	sys.stdout.flush()
+	return result
 
 def usage():
 	print """usage: [based on revision 1061]
 
-    python pkg.py target-directory [out-file]
+    python pkg.py target-directory|archive [out-file]
         -c | --contentid             list packaged files.
         -t | --contenttype          extract package.
+        --split                 write out-file.66600, out-file.66601, ...
+                                parts of at most 4 GB for FAT32.
+        --split-size            write parts of this many bytes.
 
     python pkg.py [options] npdrm-package
         -l | --list             list packaged files.
+        --json                  list as JSON.
         -x | --extract          extract package.
+        -j | --jobs             number of crypt workers (default: number of CPUs).
+
+    python pkg.py --extract-file path npdrm-package [out-file]
+        extract a single file from the package, out-file defaults to the
+        file's base name, - writes to stdout.
+
+    python pkg.py [--index file] [--query id] [--json] index directory
+        update the catalogue of all packages below directory, split ones
+        included, stored in directory/pkgindex.json unless --index is given,
+        and print the packages with contentID or TITLE_ID id.
+
+    python pkg.py diff old-package new-package delta
+    python pkg.py apply old-package delta new-package
+        write the changes from old-package to new-package as a delta, and
+        rebuild new-package from old-package and the delta.
+
+    python pkg.py --extract-to-tar out-file npdrm-package
+        write the package contents as a tar archive, - writes to stdout.
+
+    python pkg.py --patch-meta [-c contentid] [--drm-type type] npdrm-package
+        change contentID and drmType (1 network, 2 local, 3 free) of the
+        package and its EBOOT metadata in place.
+
+    python pkg.py [-j jobs] [--json] --batch manifest
+        build every package of the manifest, an ini file with one section
+        per output package, relative to the manifest:
+            [UP0001-TEST00000_00-0000000000000000.pkg]
+            folder = game
+            contentid = UP0001-TEST00000_00-0000000000000000
+            contenttype = gamedata
+            splitsize = 0xFFFF0000
+
+    python pkg.py [-j jobs] [--json] --verify npdrm-package...
+        check the header, metadata, QA and EBOOT digests of the packages.
+
+    python pkg.py --profile [--profile-trace file] [--cprofile file] ...
+        report time and throughput of the walk, read, hash, crypt, struct
+        and write stages on stderr, optionally write them as a JSON trace
+        (chrome://tracing) and/or cProfile stats. Stages on worker
+        processes (-j without pkgcrypt) are not included.
 
     python pkg.py [options]
         --version               print revision.
@@ -591,12 +2038,27 @@ def version():
 
 def main():
 	global debug
+	global jobs
+	global profiler
 	extract = False
 	list = False
 	contentid = None
 	contenttype = "gamedata"
+	fileToGet = None
+	asJson = False
+	indexFile = None
+	query = None
+	verify = False
+	tarName = None
+	manifest = None
+	splitSize = None
+	patch = False
+	drmType = None
+	profile = False
+	traceName = None
+	cprofileName = None
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "hx:dvl:c:t:", ["help", "extract=", "debug","version", "list=", "contentid=", "contenttype="])
+		opts, args = getopt.getopt(sys.argv[1:], "hx:dvl:c:t:j:", ["help", "extract=", "debug","version", "list=", "contentid=", "contenttype=", "jobs=", "extract-file=", "json", "index=", "query=", "verify", "extract-to-tar=", "batch=", "split", "split-size=", "patch-meta", "drm-type=", "profile", "profile-trace=", "cprofile="])
 	except getopt.GetoptError:
 		usage()
 		sys.exit(2)
@@ -619,18 +2081,100 @@ def main():
 			contentid = arg
 		elif opt in ("-t", "--contenttype"):
 			contenttype = arg
+		elif opt in ("-j", "--jobs"):
+			jobs = int(arg)
+		elif opt == "--extract-file":
+			fileToGet = arg
+		elif opt == "--json":
+			asJson = True
+		elif opt == "--index":
+			indexFile = arg
+		elif opt == "--query":
+			query = arg
+		elif opt == "--verify":
+			verify = True
+		elif opt == "--extract-to-tar":
+			tarName = arg
+		elif opt == "--batch":
+			manifest = arg
+		elif opt == "--split":
+			splitSize = SPLIT_SIZE
+		elif opt == "--split-size":
+			splitSize = int(arg, 0)
+		elif opt == "--patch-meta":
+			patch = True
+		elif opt == "--drm-type":
+			drmType = int(arg, 0)
+		elif opt == "--profile":
+			profile = True
+		elif opt == "--profile-trace":
+			profile = True
+			traceName = arg
+		elif opt == "--cprofile":
+			profile = True
+			cprofileName = arg
 		else:
 			usage()
 			sys.exit(2)
-	if extract:
-		unpack(fileToExtract)
+	if profile:
+		profiler = Profiler(traceName != None)
+		cprof = None
+		if cprofileName != None:
+			import cProfile
+			cprof = cProfile.Profile()
+			cprof.enable()
+		atexit.register(finishProfile, cprof, cprofileName, traceName)
+	if fileToGet != None:
+		if len(args) not in (1, 2):
+			usage()
+			sys.exit(2)
+		try:
+			extractFile(args[0], fileToGet, (args + [None])[1])
+		except KeyError:
+			print >> sys.stderr, "%s not found in %s" % (fileToGet, args[0])
+			sys.exit(1)
+	elif patch:
+		if len(args) != 1 or (contentid == None and drmType == None):
+			usage()
+			sys.exit(2)
+		patchMeta(args[0], contentid, drmType)
+	elif manifest != None:
+		if not packBatch(manifest, jobs, asJson):
+			sys.exit(1)
+	elif tarName != None:
+		if len(args) != 1:
+			usage()
+			sys.exit(2)
+		extractToTar(args[0], tarName)
+	elif verify:
+		if len(args) == 0:
+			usage()
+			sys.exit(2)
+		if not verifyPkgs(args, jobs, asJson):
+			sys.exit(1)
+	elif extract:
+		unpack(fileToExtract, jobs)
 	elif list:
-		listPkg(fileToList)
+		listPkg(fileToList, jobs, asJson)
+	elif len(args) == 4 and args[0] == "diff" and contentid == None:
+		diffPkg(args[1], args[2], args[3])
+	elif len(args) == 4 and args[0] == "apply" and contentid == None:
+		try:
+			applyDelta(args[1], args[2], args[3], jobs, splitSize)
+		except IOError, e:
+			print >> sys.stderr, e
+			sys.exit(1)
+	elif len(args) == 2 and args[0] == "index" and contentid == None:
+		if indexFile == None:
+			indexFile = os.path.join(args[1], INDEX_FILE)
+		packages = updateIndex(args[1], indexFile, jobs)
+		if query != None:
+			printIndex(queryIndex(packages, query), asJson)
 	else:
 		if len(args) == 1 and contentid != None:
-			pack(args[0], contentid, contenttype)
+			pack(args[0], contentid, contenttype, jobs=jobs, splitSize=splitSize)
 		elif len(args) == 2 and contentid != None:
-			pack(args[0], contentid, contenttype, args[1])
+			pack(args[0], contentid, contenttype, args[1], jobs, splitSize=splitSize)
 		else:
 			usage()
 			sys.exit(2)
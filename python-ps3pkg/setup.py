@@ -1,7 +1,9 @@
 #!/usr/bin/env python2
 from distutils.core import setup, Extension
 
-module1 = Extension('pkgcrypt', sources = ['crypt.c'])
+module1 = Extension('pkgcrypt',
+                    sources = ['crypt.c', '../ps3resign/sha1.c'],
+                    include_dirs = ['../ps3resign'])
 
 setup (name = 'pkgcrypt',
        version = '1.0',
@@ -76,39 +76,46 @@ def usage():
 def version():
 	print """sfo.py 0.2"""
 	
+def parseEntries(data):
+	"""Yields (entry, key, value) for every pair of the PARAM.SFO in `data`."""
+	offset = 0
+	header = Header()
+	header.unpack(data[offset:offset+len(header)])
+	if debug:
+		print header
+		print
+	assert header.magic == SFO_MAGIC
+	assert header.unk1 == 0x00000101
+	offset += len(header)
+	off1 = header.KeyOffset
+	off2 = header.ValueOffset
+	for x in xrange(header.PairCount):
+		entry = Entry()
+		entry.unpack(data[offset:offset+len(entry)])
+		if debug and not pretty:
+			print entry
+			print
+		if debug and pretty:
+			print entry.PrettyPrint(data, off1, off2)
+			print
+		key = nullterm(data[off1+entry.key_off:])
+		if entry.value_type == SFO_STRING:
+			value = nullterm(data[off2+entry.value_off:])
+		else:
+			value = struct.unpack('<I', data[entry.value_off + off2:entry.value_off + off2 + 4])[0]
+		yield entry, key, value
+		offset += len(entry)
+
+def parseSFO(data):
+	"""Returns the key/value pairs of the PARAM.SFO in `data` as a dict."""
+	stuff = {}
+	for entry, key, value in parseEntries(data):
+		stuff[key] = value
+	return stuff
+
 def listSFO(file):
-	global debug
-	global pretty
 	with open(file, 'rb') as fp:
-		stuff = {}
-		data = fp.read()
-		offset = 0
-		header = Header()
-		header.unpack(data[offset:offset+len(header)])
-		if debug:
-			print header
-			print
-		assert header.magic == SFO_MAGIC
-		assert header.unk1 == 0x00000101
-		offset += len(header)
-		off1 = header.KeyOffset
-		off2 = header.ValueOffset
-		for x in xrange(header.PairCount):
-			entry = Entry()
-			entry.unpack(data[offset:offset+len(entry)])
-			if debug and not pretty:
-				print entry
-				print
-			if debug and pretty:
-				print entry.PrettyPrint(data, off1, off2)
-				print
-			key = nullterm(data[off1+entry.key_off:])
-			if entry.value_type == SFO_STRING:
-				value = nullterm(data[off2+entry.value_off:])
-			else:
-				value = struct.unpack('<I', data[entry.value_off + off2:entry.value_off + off2 + 4])[0]
-			stuff[key] = value
-			offset += len(entry)
+		stuff = parseSFO(fp.read())
 		if not debug:
 			print stuff
 def convertToXml(sfofile, xml):
@@ -118,41 +125,17 @@ def convertToXml(sfofile, xml):
 	
 	with open(sfofile, 'rb') as fp:
 		stuff = {}
-		data = fp.read()
-		offset = 0
-		header = Header()
-		header.unpack(data[offset:offset+len(header)])
-		if debug:
-			print header
-			print
-		assert header.magic == SFO_MAGIC
-		assert header.unk1 == 0x00000101
-		offset += len(header)
-		off1 = header.KeyOffset
-		off2 = header.ValueOffset
-		for x in xrange(header.PairCount):
-			entry = Entry()
-			entry.unpack(data[offset:offset+len(entry)])
-			if debug and not pretty:
-				print entry
-				print
-			if debug and pretty:
-				print entry.PrettyPrint(data, off1, off2)
-				print
-			key = nullterm(data[off1+entry.key_off:])
+		for entry, key, value in parseEntries(fp.read()):
 			valuenode = doc.createElement("value")
 			valuenode.setAttribute("name", key)
 			if entry.value_type == SFO_STRING:
-				value = nullterm(data[off2+entry.value_off:])
 				valuenode.setAttribute("type", "string")
 				valuenode.appendChild(doc.createTextNode(value))
 			else:
-				value = struct.unpack('<I', data[entry.value_off + off2:entry.value_off + off2 + 4])[0]
 				valuenode.setAttribute("type", "integer")
 				valuenode.appendChild(doc.createTextNode("%d" % value))
 			sfo.appendChild(valuenode)
 			stuff[key] = value
-			offset += len(entry)
 		if not debug:
 			print stuff
 	
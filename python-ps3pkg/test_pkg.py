@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+from __future__ import with_statement
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import pkg
+
+CONTENTID = "UP0001-TEST00000_00-0000000000000000"
+
+def readContents(filename):
+	"""Returns {name: data} of the files of a package."""
+	contents = {}
+	with pkg.openPkg(filename) as fp:
+		header = pkg.readHeader(fp)
+		for fileD in pkg.readFileTable(fp, header):
+			if fileD.flags & 0xFF != pkg.TYPE_DIRECTORY:
+				contents[fileD.fileName] = ''.join(pkg.decryptRange(fp, header, fileD.fileOff, fileD.fileSize))
+	return contents
+
+def writeFile(path, data):
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wb') as fp:
+		fp.write(data)
+
+class PackTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix="pkgtest")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def path(self, *names):
+		return os.path.join(self.tmp, *names)
+
+	def makeGame(self, name="game"):
+		game = self.path(name)
+		writeFile(os.path.join(game, "PARAM.SFO"), os.urandom(0x100))
+		writeFile(os.path.join(game, "USRDIR", "b"), os.urandom(0x1234))
+		writeFile(os.path.join(game, "USRDIR", "data", "d"), os.urandom(0x20))
+		return game
+
+	def makeTar(self, game, name="game.tar.gz"):
+		with tarfile.open(self.path(name), "w:gz") as tar:
+			tar.add(game, os.path.basename(game))
+		return self.path(name)
+
+	def pack(self, folder, name):
+		pkg.pack(folder, CONTENTID, "gamedata", self.path(name), quiet=True)
+		return readContents(self.path(name))
+
+	def testTarLinksPackLikeDirectory(self):
+		game = self.makeGame()
+		os.link(os.path.join(game, "USRDIR", "b"), os.path.join(game, "USRDIR", "a"))
+		os.symlink("b", os.path.join(game, "USRDIR", "c"))
+		os.symlink("../b", os.path.join(game, "USRDIR", "data", "e"))
+		fromDir = self.pack(game + "/", "dir.pkg")
+		fromTar = self.pack(self.makeTar(game), "tar.pkg")
+		self.assertEqual(fromTar, fromDir)
+		for name in ("USRDIR/a", "USRDIR/b", "USRDIR/c", "USRDIR/data/e"):
+			self.assertEqual(fromTar[name], fromDir["USRDIR/b"])
+
+	def testTarDanglingLinkIsNamed(self):
+		game = self.makeGame()
+		os.symlink("missing", os.path.join(game, "USRDIR", "c"))
+		tarName = self.makeTar(game)
+		try:
+			pkg.pack(tarName, CONTENTID, "gamedata", self.path("tar.pkg"), quiet=True)
+		except IOError, e:
+			self.assertTrue("USRDIR/c" in str(e), str(e))
+		else:
+			self.fail("dangling link was packed")
+
+	def testBatchManifestAsDocumented(self):
+		game = self.makeGame()
+		manifest = self.path("manifest.ini")
+		with open(manifest, 'wb') as fp:
+			fp.write("""[UP0001-TEST00000_00-0000000000000000.pkg]
+folder = game
+contentid = UP0001-TEST00000_00-0000000000000000
+contenttype = gamedata
+splitsize = 0xFFFF0000
+""")
+		self.assertTrue(pkg.packBatch(manifest))
+		fromBatch = readContents(self.path(CONTENTID + ".pkg"))
+		self.assertEqual(sorted(fromBatch), ["PARAM.SFO", "USRDIR/b", "USRDIR/data/d"])
+		self.assertEqual(fromBatch, self.pack(game + "/", "dir.pkg"))
+
+	def testIndexFindsSplitPackages(self):
+		game = self.makeGame()
+		os.mkdir(self.path("pkgs"))
+		pkg.pack(game, CONTENTID, "gamedata", self.path("pkgs", "split.pkg"), quiet=True, splitSize=0x1000)
+		pkg.pack(game, CONTENTID, "gamedata", self.path("pkgs", "whole.pkg"), quiet=True)
+		indexFile = self.path("index.json")
+		packages = pkg.updateIndex(self.path("pkgs"), indexFile)
+		self.assertEqual(sorted(packages), ["split.pkg.%d" % pkg.SPLIT_FIRST, "whole.pkg"])
+		for entry in packages.values():
+			self.assertEqual(entry.get("contentID"), CONTENTID)
+			self.assertEqual(entry["size"], packages["whole.pkg"]["size"])
+		parts = pkg.splitParts(self.path("pkgs", "split.pkg"))
+		with open(parts[-1], 'ab') as fp:
+			fp.write("\0")
+		packages = pkg.updateIndex(self.path("pkgs"), indexFile)
+		self.assertEqual(packages["split.pkg.%d" % pkg.SPLIT_FIRST]["size"], packages["whole.pkg"]["size"] + 1)
+
+if __name__ == "__main__":
+	unittest.main()